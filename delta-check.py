@@ -0,0 +1,118 @@
+"""Check that delta /arrive leaves a session with the same inventory as a full one.
+
+Runs the domain (illini-union-domain.py) in-process against fake-hub.py's
+Inventories. Two users get the same inventories over a series of visits: one
+through delta /arrive bodies, the other always in full. Between visits items
+are added to and removed from every bucket, and one is changed in place. One
+visit is a fresh login, which the domain answers with a 409 and the hub resends
+in full. After every visit both sessions' buckets must match and the delta
+session must be at the version the hub last sent. Exits 1 at the first
+difference.
+
+    python delta-check.py
+    python delta-check.py --visits 50 --seed 3
+"""
+from aiohttp.test_utils import TestClient, TestServer
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUCKETS = ('owned', 'carried', 'dropped', 'prize')
+
+
+def load_script(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def item(n, rng):
+    return {'id': 'thing-{}'.format(n), 'name': 'thing-{}'.format(n), 'description': 'Thing {}.'.format(n),
+            'verb': {}, 'depth': rng.randrange(3)}
+
+
+def change(inventory, rng, counter):
+    """A copy of `inventory` with a few items added, removed and edited."""
+    inventory = {b: list(items) for b, items in inventory.items()}
+    for _ in range(rng.randrange(1, 4)):
+        bucket = inventory[rng.choice(BUCKETS)]
+        roll = rng.random()
+        if roll < 0.5 or not bucket:
+            counter[0] += 1
+            bucket.append(item(counter[0], rng))
+        elif roll < 0.8:
+            bucket.pop(rng.randrange(len(bucket)))
+        else:
+            i = rng.randrange(len(bucket))
+            bucket[i] = dict(bucket[i], description=bucket[i]['description'] + ' Worn.')
+    return inventory
+
+
+def buckets(domain, user_id):
+    user = domain.domain_state['users'][user_id]
+    return {b: sorted(json.dumps(i, sort_keys=True) for i in getattr(user, b)) for b in BUCKETS}
+
+
+async def arrive(client, inventories, user, origin, inventory):
+    """/arrive as the hub does it; returns the statuses seen."""
+    statuses = []
+    async with client.post('/arrive', json=inventories.arrive(user, origin, None, inventory)) as resp:
+        statuses.append(resp.status)
+    if statuses[-1] == 409:
+        inventories.resync(user)
+        async with client.post('/arrive', json=inventories.arrive(user, origin, None, inventory)) as resp:
+            statuses.append(resp.status)
+    if statuses[-1] != 200:
+        raise RuntimeError('/arrive for {} answered {}'.format(user, statuses))
+    inventories.accepted(user)
+    return statuses
+
+
+async def main(args):
+    domain = load_script('domain', 'illini-union-domain.py')
+    fake_hub = load_script('fake_hub', 'fake-hub.py')
+    delta, full = fake_hub.Inventories(delta=True), fake_hub.Inventories(delta=False)
+    rng = random.Random(args.seed)
+    counter = [0]
+    inventory = {b: [] for b in BUCKETS}
+    relogin = args.visits // 2
+    resynced = 0
+    async with TestClient(TestServer(domain.build_app())) as client:
+        for visit in range(args.visits):
+            inventory = change(inventory, rng, counter)
+            origin = 'login' if visit in (0, relogin) else 'south'
+            statuses = await arrive(client, delta, 'delta', origin, inventory)
+            await arrive(client, full, 'full', origin, inventory)
+            resynced += 409 in statuses
+            got, want = buckets(domain, 'delta'), buckets(domain, 'full')
+            if got != want:
+                print('visit {}: the delta session differs from the full one'.format(visit))
+                for b in BUCKETS:
+                    if got[b] != want[b]:
+                        print('  {}: delta {} full {}'.format(b, got[b], want[b]))
+                sys.exit(1)
+            version = domain.domain_state['users']['delta'].inventory_version
+            if version != delta.accepted_versions['delta'][0]:
+                print('visit {}: the domain is at version {}, the hub at {}'.format(
+                    visit, version, delta.accepted_versions['delta'][0]))
+                sys.exit(1)
+            for user in ('delta', 'full'):
+                async with client.post('/depart', json={'user': user}) as resp:
+                    assert resp.status == 200
+    if resynced != 1:
+        print('expected exactly one 409 resync (at the second login), saw {}'.format(resynced))
+        sys.exit(1)
+    print('{} visits, {} items, one 409 resync: delta and full sessions match'.format(args.visits, counter[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--visits', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
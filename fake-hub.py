@@ -0,0 +1,146 @@
+"""A stand-in hub server for benchmarking and testing the domain locally.
+
+Implements the hub endpoints the domain calls (/register, /transfer, /score)
+with a configurable response latency, and counts what it receives. Run it on
+its own, or load it from another script and call make_app(). Inventories builds
+the hub's side of /arrive, in full or as a delta against what the domain has, and
+play_token() gives a player the token the domain's /ws asks for.
+"""
+from aiohttp import web
+from aiohttp.web import Request, Response, json_response
+import asyncio
+import hashlib
+import hmac
+import random
+
+BUCKETS = ('owned', 'carried', 'dropped', 'prize')
+
+
+class Inventories:
+    """Per-user /arrive bodies for one domain, with the versioned delta protocol.
+
+    Remembers each user's inventory at the version the domain last accepted. arrive()
+    then sends only what changed since (`base` and `changes`), or everything when there
+    is no accepted version; after a 409 call resync() and send it in full again.
+    """
+
+    def __init__(self, delta=True):
+        self.delta = delta
+        self.accepted_versions = {}
+        self.sent = {}
+
+    def arrive(self, user, origin, secret, inventory):
+        """The /arrive body for a user whose inventory is now {bucket: [items]}."""
+        current = {b: {item['id']: item for item in inventory.get(b, ())} for b in BUCKETS}
+        last = self.accepted_versions.get(user)
+        version = last[0] + 1 if last is not None else 1
+        body = {'user': user, 'from': origin, 'secret': secret, 'version': version}
+        if self.delta and last is not None:
+            changes = {}
+            for b in BUCKETS:
+                before, after = last[1][b], current[b]
+                add = [item for item_id, item in after.items() if before.get(item_id) != item]
+                remove = [item_id for item_id in before if item_id not in after]
+                if add or remove:
+                    changes[b] = {'add': add, 'remove': remove}
+            body.update(base=last[0], changes=changes)
+        else:
+            body.update({b: list(current[b].values()) for b in BUCKETS})
+        self.sent[user] = (version, current)
+        return body
+
+    def accepted(self, user):
+        self.accepted_versions[user] = self.sent.pop(user)
+
+    def resync(self, user):
+        self.accepted_versions.pop(user, None)
+        self.sent.pop(user, None)
+
+
+def play_token(secret, user):
+    """The token that lets a player play `user` over a domain's /ws."""
+    return hmac.new((secret or '').encode(), str(user).encode(), hashlib.sha256).hexdigest()
+
+
+def make_app(latency=0.0, jitter=0.0, fail_rate=0.0):
+    """Build the hub app. Every call sleeps latency +/- jitter seconds and fails
+    (HTTP 503) with probability fail_rate."""
+    app = web.Application()
+    app['state'] = state = {
+        'domains': {},
+        'items': {},
+        'next_id': 1,
+        'counts': {'register': 0, 'transfer': 0, 'score': 0, 'failed': 0},
+        'scores': {},
+    }
+    routes = web.RouteTableDef()
+
+    async def delay():
+        if latency or jitter:
+            await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if fail_rate and random.random() < fail_rate:
+            state['counts']['failed'] += 1
+            return json_response(data={'error': 'hub is overloaded'}, status=503)
+        return None
+
+    @routes.post('/register')
+    async def register(req: Request) -> Response:
+        data = await req.json()
+        failed = await delay()
+        if failed is not None:
+            return failed
+        state['counts']['register'] += 1
+        domain_id = len(state['domains']) + 1
+        secret = 'secret-{}'.format(domain_id)
+        ids = []
+        for item in data['items']:
+            item_id = state['next_id']
+            state['next_id'] += 1
+            state['items'][item_id] = dict(item, id=item_id)
+            ids.append(item_id)
+        state['domains'][domain_id] = {'url': data['url'], 'secret': secret, 'items': ids}
+        return json_response(data={'id': domain_id, 'secret': secret, 'items': ids})
+
+    def check(data):
+        domain = state['domains'].get(data.get('domain'))
+        if domain is None or domain['secret'] != data.get('secret'):
+            return json_response(data={'error': 'unknown domain or bad secret'}, status=400)
+        return None
+
+    @routes.post('/transfer')
+    async def transfer(req: Request) -> Response:
+        data = await req.json()
+        failed = await delay() or check(data)
+        if failed is not None:
+            return failed
+        state['counts']['transfer'] += 1
+        return json_response(data={'ok': True})
+
+    @routes.post('/score')
+    async def score(req: Request) -> Response:
+        data = await req.json()
+        failed = await delay() or check(data)
+        if failed is not None:
+            return failed
+        state['counts']['score'] += 1
+        state['scores'][data['user']] = data['score']
+        return json_response(data={'ok': True})
+
+    @routes.get('/stats')
+    async def stats(req: Request) -> Response:
+        return json_response(data=state['counts'])
+
+    app.add_routes(routes)
+    return app
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('-p','--port', type=int, default=3300)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every hub call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds around --latency')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.jitter, args.fail_rate), host=args.host, port=args.port)
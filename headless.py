@@ -0,0 +1,176 @@
+"""Run the domain's game engine in-process, without a server or a hub.
+
+Loads illini-union-domain.py, gives the world's items ids the way a hub would, and
+drives step() directly on sessions it keeps itself. Hub effects are collected
+rather than sent.
+
+    python headless.py bench --sessions 10000
+    python headless.py replay commands.jsonl > transcript.jsonl
+    python headless.py replay commands.jsonl --expect transcript.jsonl
+    python headless.py fuzz --commands 1000000 --seed 7
+
+bench replays the playthrough from load-test.py for many sessions and reports
+commands per second. replay reads {"user": ..., "command": [...]} lines (a user's
+session starts at their first line) and prints one transcript line per command;
+with --expect it compares against an earlier transcript instead and exits 1 at the
+first difference. fuzz sends random commands and checks every reply and effect.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Engine:
+    """The domain module with a catalog registered, and sessions by user id."""
+
+    def __init__(self, world=None):
+        self.domain = domain = load_script('domain', 'illini-union-domain.py')
+        if world is not None:
+            domain.reload_world(world)
+        catalog = domain.ItemIndex()
+        for i, item in enumerate(domain.domain_state['world'].items):
+            catalog.add(dict(item, id=i + 1))
+        domain.reconcile_catalog(catalog)
+        items = {item['name']: item for item in catalog}
+        # what a hub hands a user arriving from login: prizes at each depth
+        self.prizes = [dict(items[name], depth=depth) for depth, name in enumerate(('rubber-gloves', 'piano-key'))
+                       if name in items]
+        self.prizes.append({'id': 10 ** 6, 'name': 'golden-ticket', 'description': 'A prize from the hub.',
+                            'verb': {}, 'depth': 2})
+        self.sessions = {}
+
+    def session(self, user_id):
+        user = self.sessions.get(user_id)
+        if user is None:
+            user = self.sessions[user_id] = self.domain.Session()
+            user.prize = self.domain.ItemIndex(dict(item) for item in self.prizes)
+        return user
+
+    def step(self, user_id, command):
+        return self.domain.step(self.session(user_id), command, user_id)
+
+
+def bench(engine, args):
+    playthrough = [line.split() for line in load_script('load_test', 'load-test.py').PLAYTHROUGH]
+    step, Session, ItemIndex = engine.domain.step, engine.domain.Session, engine.domain.ItemIndex
+    finished = 0
+    start = time.perf_counter()
+    for n in range(args.sessions):
+        user = Session()
+        user.prize = ItemIndex(dict(item) for item in engine.prizes)
+        for command in playthrough:
+            output, effects = step(user, command)
+            if effects and effects[-1][0] == 'score':
+                finished += 1
+    elapsed = time.perf_counter() - start
+    commands = args.sessions * len(playthrough)
+    print('{} commands in {:.2f}s: {:.0f} commands/s, {:.2f} us/command'.format(
+        commands, elapsed, commands / elapsed, elapsed / commands * 1e6))
+    print('{} of {} sessions finished the domain'.format(finished, args.sessions))
+
+
+def replay(engine, args):
+    expected = open(args.expect) if args.expect else None
+    with open(args.file) if args.file != '-' else sys.stdin as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            output, effects = engine.step(entry['user'], entry['command'])
+            result = {'user': entry['user'], 'command': entry['command'], 'output': output,
+                      'effects': [list(effect) for effect in effects]}
+            if expected is None:
+                print(json.dumps(result))
+                continue
+            want = json.loads(expected.readline() or 'null')
+            if want != result:
+                print('line {}: {} {}'.format(n, entry['user'], ' '.join(entry['command'])))
+                print('  expected: {}'.format(json.dumps(want)))
+                print('  got:      {}'.format(json.dumps(result)))
+                sys.exit(1)
+    if expected is not None:
+        print('replay matches {}'.format(args.expect))
+
+
+def fuzz(engine, args):
+    domain = engine.domain
+    verbs = sorted(domain.known_verbs) + ['dance', 'xyzzy', '']
+    words = set(domain.direction_ids) | set(name for name in domain.room_ids)
+    words.update(item['name'] for item in domain.domain_state['items'])
+    words.update(item['name'] for item in engine.prizes)
+    for verb, rest, room in domain.command_table:
+        words.update(rest.split())
+    words = sorted(words) + ['', 'nothing']
+    users = ['fuzz-{}'.format(i) for i in range(args.users)]
+
+    def commands(rng):
+        while True:
+            command = [rng.choice(verbs)] + [rng.choice(words) for _ in range(rng.randrange(3))]
+            yield rng.choice(users), [] if rng.random() < 0.01 else command
+
+    start = time.perf_counter()
+    for n, (user_id, command) in zip(range(args.commands), commands(random.Random(args.seed))):
+        try:
+            output, effects = engine.step(user_id, command)
+            problem = check(domain, engine.sessions[user_id], output, effects)
+        except Exception as e:
+            problem = repr(e)
+        if problem is not None:
+            print('command {} for {} (seed {}): {}'.format(n, user_id, args.seed, problem))
+            print("that session's commands, for replay:")
+            # the same seed draws the same commands again
+            for _, (other, line) in zip(range(n + 1), commands(random.Random(args.seed))):
+                if other == user_id:
+                    print(json.dumps({'user': user_id, 'command': line}))
+            sys.exit(1)
+    elapsed = time.perf_counter() - start
+    print('{} commands in {:.2f}s ({:.0f} commands/s), no problems'.format(
+        args.commands, elapsed, args.commands / elapsed))
+
+
+def check(domain, user, output, effects):
+    """What is wrong with a step's result, or None."""
+    if not isinstance(output, str):
+        return 'output is {!r}'.format(type(output))
+    if not domain.domain_state['world'].has_room(user.location):
+        return 'user is in {!r}, which is not a room'.format(domain.room_names[user.location])
+    for effect in effects:
+        if effect[0] == 'transfer':
+            if len(effect) != 3:
+                return 'bad effect {!r}'.format(effect)
+        elif effect[0] != 'score' or len(effect) != 2:
+            return 'bad effect {!r}'.format(effect)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world', type=str, default=None, help='world file (default: the domain\'s)')
+    modes = parser.add_subparsers(dest='mode', required=True)
+    p = modes.add_parser('bench', help='replay the load-test playthrough and report commands/s')
+    p.add_argument('--sessions', type=int, default=10000)
+    p.set_defaults(run=bench)
+    p = modes.add_parser('replay', help='run commands from a JSON lines file and print or check the transcript')
+    p.add_argument('file', help='JSON lines of {"user": ..., "command": [...]}, or - for stdin')
+    p.add_argument('--expect', type=str, default=None, help='transcript to compare against')
+    p.set_defaults(run=replay)
+    p = modes.add_parser('fuzz', help='send random commands and check every result')
+    p.add_argument('--commands', type=int, default=100000)
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(run=fuzz)
+    args = parser.parse_args()
+    args.run(Engine(args.world), args)
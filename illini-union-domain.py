@@ -1,58 +1,933 @@
-from aiohttp import web
+from aiohttp import web, ClientError, WSCloseCode
 from aiohttp.web import Request, Response, json_response
+from collections import OrderedDict, deque
+import asyncio
+import bisect
+import cProfile
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import pickle
+import pstats
+import queue
 import random
+import secrets
+import shelve
+import signal
+import struct
+import threading
+import time
+import zlib
+# optional: a faster JSON codec, and msgpack for hubs that speak it (see the wire codec)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 routes = web.RouteTableDef()
 
 hub_server_url = None
 domain_id = None
 domain_secret = None
+# a StateJournal when the server runs with --state-dir
+state_journal = None
+# with --workers N: this process's index, the private URL of every worker, and the
+# token workers use to trust each other's internal requests
+worker_index = None
+worker_peers = []
+internal_token = None
+
+class ItemIndex:
+    """A bucket of items keyed by id, with a secondary index by name.
+
+    Used for the item catalog and for every per-user inventory bucket so that
+    membership checks and moves between buckets are O(1) instead of list scans.
+    """
+    __slots__ = ('by_id', 'by_name')
+
+    def __init__(self, items=()):
+        self.by_id = {}
+        self.by_name = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """Add an item, replacing any item already there with the same id."""
+        if item['id'] in self.by_id:
+            self.pop(item['id'])
+        self.by_id[item['id']] = item
+        # several items can share a name (e.g. carried from other domains), keep their ids in order
+        self.by_name.setdefault(item['name'], {})[item['id']] = None
+
+    def pop(self, item_id, default=None):
+        item = self.by_id.pop(item_id, None)
+        if item is None:
+            return default
+        ids = self.by_name[item['name']]
+        del ids[item_id]
+        if not ids:
+            del self.by_name[item['name']]
+        return item
+
+    def ids_named(self, name):
+        return self.by_name.get(name, ())
+
+    def find(self, key):
+        """Look up an item by id or by name, as typed in a command."""
+        item = self.by_id.get(key)
+        if item is None and isinstance(key, str):
+            ids = self.by_name.get(key)
+            if ids:
+                item = self.by_id[next(iter(ids))]
+            elif key.isdigit():
+                item = self.by_id.get(int(key))
+        return item
+
+    def __contains__(self, item_id):
+        return item_id in self.by_id
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __repr__(self):
+        return 'ItemIndex({!r})'.format(list(self.by_id.values()))
+
+
+# Puzzle progress is declared as state machines. Every puzzle owns a few bits of
+# Session.state, a single int that starts at 0 (each puzzle's first state), and its
+# transitions are compiled into one tuple per event indexed by the current state.
+puzzles = []
+puzzle_bits = 0
+
+class Puzzle:
+    """One puzzle's states and the events that move between them.
+
+    `transitions` maps an event to {from state: to state}; an event fired in a state
+    it does not list leaves the puzzle where it is. Use the ids in `ids` to compare
+    with stage().
+    """
+    __slots__ = ('name', 'states', 'ids', 'shift', 'mask', 'table')
+
+    def __init__(self, name, states, transitions):
+        global puzzle_bits
+        self.name = name
+        self.states = tuple(states)
+        self.ids = {state: i for i, state in enumerate(self.states)}
+        bits = max(1, (len(self.states) - 1).bit_length())
+        self.shift = puzzle_bits
+        self.mask = (1 << bits) - 1
+        puzzle_bits += bits
+        self.table = {}
+        for event, moves in transitions.items():
+            row = [-1] * len(self.states)
+            for source, target in moves.items():
+                if source not in self.ids or target not in self.ids:
+                    raise ValueError('{}: {!r} moves between unknown states {!r} -> {!r}'.format(name, event, source, target))
+                row[self.ids[source]] = self.ids[target]
+            self.table[event] = tuple(row)
+        puzzles.append(self)
+
+    def stage(self, user):
+        return (user.state >> self.shift) & self.mask
+
+    def fire(self, user, event):
+        """Apply an event to the user's puzzle; False if it does nothing in the current state."""
+        target = self.table[event][(user.state >> self.shift) & self.mask]
+        if target < 0:
+            return False
+        user.state = (user.state & ~(self.mask << self.shift)) | (target << self.shift)
+        user.view = None
+        analytics.stage(self, target)
+        return True
+
+    def set(self, user, state):
+        user.state = (user.state & ~(self.mask << self.shift)) | (self.ids[state] << self.shift)
+
+fish_tank = Puzzle('fish tank', ['with card', 'card discovered', 'card taken'], {
+    'fish': {'with card': 'card discovered', 'card discovered': 'card taken'},
+})
+closet_door = Puzzle('closet door', ['locked', 'unlocked'], {
+    'swipe': {'locked': 'unlocked'},
+})
+piano = Puzzle('piano', ['missing key', 'fixed', 'open'], {
+    'insert key': {'missing key': 'fixed'},
+    'open': {'fixed': 'open'},
+})
+starbucks = Puzzle('starbucks', ['has drink', 'drink served', 'drink taken'], {
+    'serve': {'has drink': 'drink served'},
+    'pick up': {'drink served': 'drink taken'},
+})
+drink = Puzzle('drink', ['undiscovered', 'investigated'], {
+    'spill': {'undiscovered': 'investigated'},
+})
+CARD_HIDDEN, CARD_DISCOVERED, CARD_TAKEN = (fish_tank.ids[s] for s in fish_tank.states)
+CLOSET_LOCKED, CLOSET_UNLOCKED = (closet_door.ids[s] for s in closet_door.states)
+PIANO_MISSING_KEY, PIANO_FIXED, PIANO_OPEN = (piano.ids[s] for s in piano.states)
+HAS_DRINK, DRINK_SERVED, DRINK_TAKEN = (starbucks.ids[s] for s in starbucks.states)
+# the puzzles room renders depend on (see view_id)
+render_state_mask = (fish_tank.mask << fish_tank.shift) | (piano.mask << piano.shift)
+
+
+class Session:
+    """One user's game state in this domain.
+
+    Catalog items are shared by every session and never mutated. A session only
+    records the world items it has moved (`moved`, item id -> location), so its
+    size grows with what the user changed rather than with the catalog.
+
+    Locations are interned room ids (see intern_room) and `state` packs the stage of
+    every Puzzle; pickles hold room and state names so saved sessions survive changes
+    to the world file and to the puzzles. `spill` is the room the drink was spilled
+    in, or None.
+
+    `view` identifies everything room renders depend on (see view_id); it is reset
+    whenever puzzle state, item locations or prizes change, and is not persisted.
+    `changes` counts changes to the overlay and the inventory buckets, so run_command
+    can tell whether a command changed anything that needs saving; nor is it.
+    """
+    __slots__ = ('location', 'state', 'spill', 'moved', 'owned', 'carried', 'dropped', 'prize',
+                 'inventory_version', 'started', 'view', 'changes')
+
+    def __init__(self):
+        self.location = domain_state['world'].start
+        self.state = 0
+        self.spill = None
+        self.moved = None
+        self.owned = ItemIndex()
+        self.carried = ItemIndex()
+        self.dropped = ItemIndex()
+        self.prize = ItemIndex()
+        # the hub's version of the inventory buckets above, for delta /arrive; None if unversioned
+        self.inventory_version = None
+        # when the session began (time.time()), for the time-to-finish stats
+        self.started = time.time()
+        self.view = None
+        self.changes = 0
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__ if name not in ('view', 'changes')}
+        state['generation'] = len(id_remaps)
+        state['location'] = room_names[self.location]
+        state['state'] = {puzzle.name: puzzle.states[puzzle.stage(self)] for puzzle in puzzles}
+        if self.spill is not None:
+            state['spill'] = room_names[self.spill]
+        if self.moved is not None:
+            state['moved'] = {item_id: room_names[room] for item_id, room in self.moved.items()}
+        return state
+
+    def __setstate__(self, state):
+        generation = state.pop('generation', len(id_remaps))
+        self.inventory_version = None
+        self.started = None
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.location = intern_room(self.location)
+        stages, self.state = self.state, 0
+        for puzzle in puzzles:
+            if stages.get(puzzle.name) in puzzle.ids:
+                puzzle.set(self, stages[puzzle.name])
+        if self.spill is not None:
+            self.spill = intern_room(self.spill)
+        if self.moved is not None:
+            self.moved = {item_id: intern_room(name) for item_id, name in self.moved.items()}
+        # catalog ids the hub changed since this session was saved
+        self.view = None
+        self.changes = 0
+        for mapping in id_remaps[generation:]:
+            self.remap_items(mapping)
+
+    def remap_items(self, mapping):
+        """Rename catalog item ids (old id -> new id) after a re-registration changed them."""
+        if self.moved is not None:
+            self.moved = {mapping.get(item_id, item_id): room for item_id, room in self.moved.items()}
+        for name in ('owned', 'carried', 'dropped', 'prize'):
+            bucket = getattr(self, name)
+            if any(item_id in mapping for item_id in bucket.by_id):
+                setattr(self, name, ItemIndex(dict(item, id=mapping[item['id']]) if item['id'] in mapping else item
+                                              for item in bucket))
+        self.view = None
+
+    def item_location(self, item):
+        """Where a catalog item is for this user: its overlay entry, else the shared default."""
+        if self.moved is not None and item['id'] in self.moved:
+            return self.moved[item['id']]
+        return domain_state['world'].homes.get(item['name'])
+
+    def move_item(self, item, location):
+        """Record a catalog item's new location, dropping the entry once it is back home."""
+        self.view = None
+        self.changes += 1
+        if location == domain_state['world'].homes.get(item['name']):
+            if self.moved is not None:
+                self.moved.pop(item['id'], None)
+                if not self.moved:
+                    self.moved = None
+        else:
+            if self.moved is None:
+                self.moved = {}
+            self.moved[item['id']] = location
+
+    def find_world_item(self, key):
+        """A catalog item that is still lying in the world (not taken) for this user."""
+        item = domain_state['items'].find(key)
+        if item is not None and self.item_location(item) != INVENTORY:
+            return item
+        return None
+
+class SessionStore:
+    """Sessions by user id (domain_state['users']) with a bounded resident set.
+
+    Resident sessions are kept in least-recently-used order. Once more than
+    `max_resident` are in memory, the coldest ones are pickled to a shelve file at
+    `spill_path` and faulted back in on their next lookup. Departed users are moved
+    to the cold end (see park), so they are spilled before anyone still playing.
+    With no `max_resident` nothing is ever spilled.
+
+    Sessions restored by StateJournal stay pickled in `restored` until first used.
+    `away` counts the resident sessions whose user has departed, for /metrics; move
+    resident users in or out of AWAY with relocate() to keep it right.
+    """
+
+    def __init__(self, max_resident=None, spill_path=None):
+        self.resident = OrderedDict()
+        self.max_resident = max_resident
+        self.spill_path = spill_path
+        self.spilled = None
+        self.restored = {}
+        # user ids changed since the journal last flushed; None when not journaling
+        self.dirty = None
+        self.spills = 0
+        self.faults = 0
+        self.away = 0
+
+    @staticmethod
+    def key(user_id):
+        # shelve keys are strings; repr keeps 1 and '1' apart
+        return repr(user_id)
+
+    def disk(self):
+        if self.spilled is None:
+            self.spilled = shelve.open(self.spill_path, flag='n', protocol=pickle.HIGHEST_PROTOCOL)
+        return self.spilled
+
+    def get(self, user_id, default=None):
+        user = self.resident.get(user_id)
+        if user is not None:
+            self.resident.move_to_end(user_id)
+            return user
+        data = self.restored.pop(user_id, None)
+        if data is not None:
+            user = self.resident[user_id] = pickle.loads(data)
+            self.away += user.location == AWAY
+            self.evict()
+            return user
+        if self.spilled is not None:
+            user = self.spilled.pop(self.key(user_id), None)
+            if user is not None:
+                self.faults += 1
+                self.resident[user_id] = user
+                self.away += user.location == AWAY
+                self.evict()
+                return user
+        return default
+
+    def __getitem__(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __setitem__(self, user_id, user):
+        old = self.resident.get(user_id)
+        if old is not None:
+            self.away -= old.location == AWAY
+        self.away += user.location == AWAY
+        self.resident[user_id] = user
+        self.resident.move_to_end(user_id)
+        self.restored.pop(user_id, None)
+        if self.spilled is not None:
+            self.spilled.pop(self.key(user_id), None)
+        self.evict()
+
+    def __contains__(self, user_id):
+        return (user_id in self.resident or user_id in self.restored
+                or (self.spilled is not None and self.key(user_id) in self.spilled))
+
+    def __len__(self):
+        return len(self.resident) + len(self.restored) + (len(self.spilled) if self.spilled is not None else 0)
+
+    def touch(self, user_id):
+        """Note that a session changed, so the journal writes it out."""
+        if self.dirty is not None:
+            self.dirty.add(user_id)
+
+    def dump(self, user_id):
+        """The pickled form of a session wherever it lives, or None if it is gone."""
+        user = self.resident.get(user_id)
+        if user is not None:
+            return pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+        if user_id in self.restored:
+            return self.restored[user_id]
+        if self.spilled is not None:
+            try:
+                # the shelve's underlying dbm already holds the pickle
+                return self.spilled.dict[self.key(user_id).encode()]
+            except KeyError:
+                pass
+        return None
+
+    def relocate(self, user, location):
+        """Move a resident session's user to `location`."""
+        self.away += (location == AWAY) - (user.location == AWAY)
+        user.location = location
+
+    def park(self, user_id):
+        """Mark a resident session as cold, making it the next to be spilled."""
+        if user_id in self.resident:
+            self.resident.move_to_end(user_id, last=False)
+        self.evict()
+
+    def evict(self):
+        if self.max_resident is None:
+            return
+        while len(self.resident) > self.max_resident:
+            user_id, user = self.resident.popitem(last=False)
+            self.away -= user.location == AWAY
+            self.disk()[self.key(user_id)] = user
+            self.spills += 1
+
+    def clear(self):
+        self.resident.clear()
+        self.away = 0
+        self.restored.clear()
+        if self.dirty is not None:
+            self.dirty.clear()
+        if self.spilled is not None:
+            self.spilled.clear()
+
+    def close(self):
+        if self.spilled is not None:
+            self.spilled.close()
+            self.spilled = None
+
+# The world (rooms, exits and items) lives in a JSON file and is compiled into a
+# World whose rooms and directions are small ints, so moving is two list indexes.
+# Room and direction ids are interned append-only and never reused: a reload can
+# add or drop rooms, but an id held by a live session always names the same room.
+room_ids = {}
+room_names = []
+direction_ids = {}
+
+def intern_room(name):
+    room = room_ids.get(name)
+    if room is None:
+        room = room_ids[name] = len(room_names)
+        room_names.append(name)
+    return room
+
+def intern_direction(name):
+    direction = direction_ids.get(name)
+    if direction is None:
+        direction = direction_ids[name] = len(direction_ids)
+    return direction
+
+# pseudo-rooms: a user between visits, and a world item a user has picked up
+AWAY = intern_room('away')
+INVENTORY = intern_room('inventory')
+# rooms the puzzles refer to by name
+LOBBY = intern_room('lobby')
+HALLWAY = intern_room('hallway')
+CLOSET = intern_room('closet')
+
+world_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'world.json')
+
+class World:
+    """A compiled world file.
+
+    `descriptions[room]` is a room's text, None for ids that are not rooms of this
+    world. `exits[room][direction]` is a room id, a reply for the hub (such as
+    '$journey east'), or None; rows may be shorter than the number of directions.
+    `entrances` maps the direction a user arrives from to a room, and `homes` maps
+    item names to the room the item starts in.
+    """
+    __slots__ = ('name', 'description', 'start', 'entrances', 'descriptions', 'exits', 'items', 'homes')
+
+    def has_room(self, room):
+        return 0 <= room < len(self.descriptions) and self.descriptions[room] is not None
+
+    def rooms(self):
+        return [room for room in range(len(self.descriptions)) if self.descriptions[room] is not None]
+
+def compile_world(data):
+    """Build a World from the parsed world file, raising ValueError if it is inconsistent."""
+    world = World()
+    world.name = data['name']
+    world.description = data['description']
+    rooms = data['rooms']
+
+    def room_id(name, where):
+        if name not in rooms:
+            raise ValueError('{} refers to unknown room {!r}'.format(where, name))
+        return intern_room(name)
+
+    for name in rooms:
+        intern_room(name)
+    world.descriptions = [None] * len(room_names)
+    world.exits = [None] * len(room_names)
+    for name, room in rooms.items():
+        r = room_ids[name]
+        world.descriptions[r] = room['description']
+        row = []
+        for direction, destination in room.get('exits', {}).items():
+            d = intern_direction(direction)
+            if len(row) <= d:
+                row.extend([None] * (d + 1 - len(row)))
+            if destination.startswith('$'):
+                row[d] = destination
+            else:
+                row[d] = room_id(destination, 'exit {} of {}'.format(direction, name))
+        world.exits[r] = row
+    world.start = room_id(data['start'], 'start')
+    world.entrances = {direction: room_id(name, 'entrance ' + direction)
+                       for direction, name in data.get('entrances', {}).items()}
+    world.items = data['items']
+    names = [item['name'] for item in world.items]
+    if len(set(names)) != len(names):
+        raise ValueError('item names must be unique')
+    world.homes = {item['name']: room_id(item['location'], 'item ' + item['name'])
+                   for item in world.items if 'location' in item}
+    return world
+
+def load_world(path):
+    with open(path) as f:
+        return compile_world(json.load(f))
+
+def reload_world(path=None):
+    """Recompile the world file and swap it in. Sessions stay where they are; users in
+    rooms that no longer exist are moved to the start room on their next command.
+    Changed items take effect at the next /newhub."""
+    global world_path
+    world = load_world(path or world_path)
+    if path:
+        world_path = path
+    domain_state['world'] = world
+    compile_commands()
+    # descriptions and item homes may have changed under cached renders
+    invalidate_views()
+    return world
+
+def try_reload_world():
+    """reload_world for SIGHUP: a broken world file leaves the current world in place."""
+    try:
+        world = reload_world()
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print('world reload failed, keeping the current world: {!r}'.format(e))
+        return None
+    print('reloaded {} ({} rooms)'.format(world_path, len(world.rooms())))
+    sockets.push_all()
+    return world
+
+@routes.post('/world/reload')
+async def handle_world_reload(req: Request) -> Response:
+    """Recompile the world file without a restart (as does SIGHUP)."""
+    refused = refuse_operator(req)
+    if refused is not None:
+        return refused
+    try:
+        world = reload_world()
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return json_response(data={'error': 'world reload failed: {!r}'.format(e)}, status=400)
+    sockets.push_all()
+    return json_response(data={'ok': True, 'rooms': len(world.rooms())})
+
+async def watch_world_signal(app):
+    """Reload the world file on SIGHUP."""
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, try_reload_world)
 
 domain_state = {
-    'rooms': {
-        'lobby': {
-            'description': "You're in the lobby of the Union, unless it is a waiting room? There are a chairs and tables all around the room. You see a help desk to the east and a few fish swimming in a fish tank in the middle of the room. To the west is a pair of double doors leading to a hallway of some kind. To the south is multiple leading to what looks like a courtyard. You can exit to the north.",
-            'visited': False,
-            'west': 'hallway',
-            'north': 'exit',
-            'south': 'courtyard',
-        },
-        'hallway': {
-            'description': "You're in a long hallway with many windows and doors. To the North, you see a lobby with many chairs and tables. To the South you see an ornate lounge with a lot of sunshine. To the West, you see a closet and many exit doors blocked off for construction. Lastly, in the east you double doors leading you to a courtyard.",
-            'visited': False,
-            'east': 'courtyard',
-            'north': 'lobby',
-            'south': 'lounge',
-            'west': 'closet'
-        },
-        'courtyard': {
-            'description': "You're in the courtyard, you see many chairs and tables, some people are studying, others gossiping, most of them scrolling on instagram trying to 'lock in'. You get a whiff of coffe from the Starbucks to the east. You look to the west and see a hallway with exit doors. The Union lobby is through the double doors on the north side. You also see stage with a microphone in the room, you suddenly find the urge to sing.",
-            'visited': False,
-            'north': 'lobby',
-            'west': 'hallway',
-            'east': 'starbucks',
-        },
-        'starbucks': {
-            'description': "You follow the smell of coffee into the Starbucks. You read the menu and see students have ordered so many drinks during finals week, the only drink left is a peppermint mocha. Should you order a drink? The courtyard is to the west.",
-            'visited': False,
-            'west': 'courtyard',
-        },
-        'lounge': {
-            'description': "The sunshine draws you into the lounge. The antique decor and beautiful view of the quad are serene. You see a piano in the corner of the room, and feel an urge to play the piano. You see the hallway to the west.",
-            'visited': False,
-            'west': 'hallway',
-        },
-        'closet': {
-            'description': "You're in a closet with brooms and dustpans around. You look up and see a music note on a note-sheet peeking over the edge of the shelf. You can exit the closet east to the hallway.",
-            'visited': False,
-            'east': 'hallway',
-        }
-    },
-    'items': [],
+    'world': load_world(world_path),
+    'items': ItemIndex(),
     # contains everything about user state including furniture state as well as user inventory, etc.
-    'users': {},
+    'users': SessionStore(),
 }
 
+# Wire codec. Hub requests are decoded once, at the edge, into slotted Message
+# structs whose fields have been checked, so handlers never meet a missing key or a
+# wrong type. Bodies are JSON (parsed with orjson when installed), or msgpack when
+# the hub sends Content-Type: application/msgpack; replies use msgpack when the
+# hub's Accept header asks for it.
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+class BadMessage(ValueError):
+    pass
+
+def decode_bytes(body, content_type):
+    if content_type in MSGPACK_TYPES:
+        if msgpack is None:
+            raise web.HTTPUnsupportedMediaType(text='msgpack is not available on this domain')
+        return msgpack.unpackb(body, raw=False)
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+def wants_msgpack(req):
+    return msgpack is not None and any(t in req.headers.get('Accept', '') for t in MSGPACK_TYPES)
+
+def reply(req, data, status=200):
+    """A response carrying data in the encoding the hub asked for."""
+    if wants_msgpack(req):
+        return Response(body=msgpack.packb(data), status=status, content_type='application/msgpack')
+    if orjson is not None:
+        return Response(body=orjson.dumps(data), status=status, content_type='application/json')
+    return json_response(data=data, status=status)
+
+def refuse_operator(req):
+    """A 403 for a request that may not use the operator endpoints (/debug/...,
+    /world/reload), else None.
+
+    They need the domain secret in X-Domain-Secret, or, before /newhub has given the
+    domain one, any X-Domain-Secret from this machine; other workers send the internal
+    token. A custom header also keeps web pages out: browsers will not send one
+    cross-origin without a CORS preflight, which this server never answers.
+    """
+    if internal_token is not None and req.headers.get('X-Internal-Token') == internal_token:
+        return None
+    secret = req.headers.get('X-Domain-Secret')
+    if secret is not None:
+        if domain_secret is None:
+            if req.remote in ('127.0.0.1', '::1'):
+                return None
+        elif hmac.compare_digest(secret.encode(), domain_secret.encode()):
+            return None
+    return json_response(data={'error': 'needs the domain secret in X-Domain-Secret'}, status=403)
+
+def check_user(key, value):
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise BadMessage('{} must be a string or an integer'.format(key))
+    return value
+
+def check_text(key, value):
+    if not isinstance(value, str):
+        raise BadMessage('{} must be a string'.format(key))
+    return value
+
+def check_words(key, value):
+    if not isinstance(value, list) or not all(isinstance(word, str) for word in value):
+        raise BadMessage('{} must be a list of strings'.format(key))
+    return value
+
+def check_item(key, value):
+    if not isinstance(value, dict):
+        raise BadMessage('{} must be an object'.format(key))
+    item_id = value.get('id')
+    if isinstance(item_id, bool) or not isinstance(item_id, (str, int)):
+        raise BadMessage('{} needs an id'.format(key))
+    if not isinstance(value.get('name'), str):
+        raise BadMessage('{} needs a name'.format(key))
+    if not isinstance(value.setdefault('verb', {}), dict):
+        raise BadMessage('{} verb must be an object'.format(key))
+    depth = value.get('depth')
+    if depth is not None and (isinstance(depth, bool) or not isinstance(depth, int)):
+        raise BadMessage('{} depth must be an integer'.format(key))
+    return value
+
+def check_int(key, value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise BadMessage('{} must be an integer'.format(key))
+    return value
+
+def check_changes(key, value):
+    """Delta /arrive changes: {bucket: {"add": [items], "remove": [item ids]}}."""
+    if not isinstance(value, dict):
+        raise BadMessage('{} must be an object'.format(key))
+    for bucket, change in value.items():
+        where = '{}.{}'.format(key, bucket)
+        if bucket not in INVENTORY_BUCKETS:
+            raise BadMessage('{} is not an inventory bucket'.format(where))
+        if not isinstance(change, dict):
+            raise BadMessage('{} must be an object'.format(where))
+        check_items(where + '.add', change.setdefault('add', []))
+        removed = change.setdefault('remove', [])
+        if not isinstance(removed, list) or any(isinstance(i, bool) or not isinstance(i, (str, int)) for i in removed):
+            raise BadMessage('{}.remove must be a list of item ids'.format(where))
+    return value
+
+def check_items(key, value):
+    if not isinstance(value, list):
+        raise BadMessage('{} must be a list'.format(key))
+    for i, item in enumerate(value):
+        check_item('{}[{}]'.format(key, i), item)
+    return value
+
+REQUIRED = object()
+
+class Message:
+    """A decoded request body. `fields` lists (attribute, key, check, default); a
+    field whose default is REQUIRED must be present."""
+    __slots__ = ()
+    fields = ()
+
+    @classmethod
+    def decode(cls, data):
+        if not isinstance(data, dict):
+            raise BadMessage('expected an object')
+        msg = cls.__new__(cls)
+        for attr, key, check, default in cls.fields:
+            value = data.get(key, default)
+            if value is REQUIRED:
+                raise BadMessage('missing {}'.format(key))
+            setattr(msg, attr, value if value is default else check(key, value))
+        return msg
+
+INVENTORY_BUCKETS = ('owned', 'carried', 'dropped', 'prize')
+
+class ArriveMessage(Message):
+    """A full /arrive carries every inventory bucket. A delta /arrive instead carries
+    `base`, the inventory version the domain last accepted, and `changes` since then;
+    either kind may carry `version`, the version the inventory is at afterwards."""
+    __slots__ = ('user', 'origin', 'secret', 'owned', 'carried', 'dropped', 'prize', 'version', 'base', 'changes')
+    fields = (
+        ('user', 'user', check_user, REQUIRED),
+        ('origin', 'from', check_text, REQUIRED),
+        ('secret', 'secret', check_text, None),
+        ('owned', 'owned', check_items, ()),
+        ('carried', 'carried', check_items, ()),
+        ('dropped', 'dropped', check_items, ()),
+        ('prize', 'prize', check_items, ()),
+        ('version', 'version', check_int, None),
+        ('base', 'base', check_int, None),
+        ('changes', 'changes', check_changes, None),
+    )
+
+class DepartMessage(Message):
+    __slots__ = ('user', 'secret')
+    fields = (
+        ('user', 'user', check_user, REQUIRED),
+        ('secret', 'secret', check_text, None),
+    )
+
+class DroppedMessage(Message):
+    __slots__ = ('user', 'secret', 'item')
+    fields = (
+        ('user', 'user', check_user, REQUIRED),
+        ('secret', 'secret', check_text, None),
+        ('item', 'item', check_item, REQUIRED),
+    )
+
+class CommandMessage(Message):
+    __slots__ = ('user', 'command')
+    fields = (
+        ('user', 'user', check_user, REQUIRED),
+        ('command', 'command', check_words, REQUIRED),
+    )
+
+# the body of each route that acts for one user
+route_messages = {
+    '/arrive': ArriveMessage,
+    '/depart': DepartMessage,
+    '/dropped': DroppedMessage,
+    '/command': CommandMessage,
+}
+
+def check_bool(key, value):
+    if not isinstance(value, bool):
+        raise BadMessage('{} must be true or false'.format(key))
+    return value
+
+def check_number(key, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise BadMessage('{} must be a number'.format(key))
+    return value
+
+def check_users(key, value):
+    if not isinstance(value, list):
+        raise BadMessage('{} must be a list'.format(key))
+    for i, user_id in enumerate(value):
+        check_user('{}[{}]'.format(key, i), user_id)
+    return value
+
+class SocketMessage(Message):
+    """A /ws frame: a command for a user, and/or whether to watch the user's room."""
+    __slots__ = ('id', 'user', 'token', 'command', 'watch')
+    fields = (
+        ('id', 'id', check_user, None),
+        ('user', 'user', check_user, REQUIRED),
+        ('token', 'token', check_text, None),
+        ('command', 'command', check_words, None),
+        ('watch', 'watch', check_bool, None),
+    )
+
+# A body is decoded once per request, by whichever of the middlewares (admission,
+# shard routing, profiling) or the handler needs it first; the result, or the error
+# to answer with, is kept in req['msg'] for the rest.
+
+async def read_message(req, cls):
+    """Decode and check a request body, answering 400 for a malformed one."""
+    msg = req.get('msg')
+    if msg is None:
+        try:
+            msg = cls.decode(decode_bytes(await req.read(), req.content_type))
+        except ValueError as e:
+            # BadMessage, and JSON/msgpack syntax errors (all ValueErrors)
+            msg = web.HTTPBadRequest(body=json.dumps({'error': 'bad {} body: {}'.format(req.path, e)}),
+                                     content_type='application/json')
+        except web.HTTPException as e:
+            msg = e
+        req['msg'] = msg
+    if isinstance(msg, web.HTTPException):
+        raise msg
+    return msg
+
+async def read_batch(req):
+    """Decode a /commands body into CommandMessages."""
+    entries = req.get('msg')
+    if entries is None:
+        try:
+            entries = decode_bytes(await req.read(), req.content_type)
+            if not isinstance(entries, list):
+                raise BadMessage('the body must be a list')
+            entries = [CommandMessage.decode(entry) for entry in entries]
+        except ValueError as e:
+            entries = web.HTTPBadRequest(body=json.dumps({'error': 'bad /commands body: {}'.format(e)}),
+                                         content_type='application/json')
+        except web.HTTPException as e:
+            entries = e
+        req['msg'] = entries
+    if isinstance(entries, web.HTTPException):
+        raise entries
+    return entries
+
+
+class UserActors:
+    """Runs each user's requests one at a time, in the order they came in, and turns
+    work away early when the domain is overloaded.
+
+    A user with nothing in progress runs at once; later requests for that user wait in
+    the user's queue until the earlier ones finish. Once `max_pending` requests are
+    admitted (running or waiting) new ones get a 503, and once `max_queued` are
+    waiting for one user that user's next gets a 429, both with Retry-After, so
+    latency stays bounded instead of growing with the backlog. A turn for user None
+    only counts towards `max_pending` (see admit_requests).
+    """
+
+    def __init__(self, max_pending=2000, max_queued=8):
+        self.max_pending = max_pending
+        self.max_queued = max_queued
+        # user id -> futures of the requests waiting behind the running one; present while the user is busy
+        self.queues = {}
+        self.pending = 0
+        self.rejected = {'overloaded': 0, 'user_busy': 0}
+
+    def turn(self, user_id):
+        """async with actors.turn(user_id): ... runs the block as that user's next request."""
+        return Turn(self, user_id)
+
+    def check_capacity(self, n=1):
+        if self.pending + n > self.max_pending:
+            self.rejected['overloaded'] += 1
+            raise web.HTTPServiceUnavailable(text='The domain is overloaded, try again shortly.',
+                                             headers={'Retry-After': '1'})
+
+    async def acquire(self, user_id):
+        self.check_capacity()
+        if user_id is None:
+            self.pending += 1
+            return
+        waiters = self.queues.get(user_id)
+        if waiters is None:
+            self.queues[user_id] = deque()
+            self.pending += 1
+            return
+        if len(waiters) >= self.max_queued:
+            self.rejected['user_busy'] += 1
+            raise web.HTTPTooManyRequests(text='Too many requests in progress for this user.',
+                                          headers={'Retry-After': '1'})
+        turn = asyncio.get_running_loop().create_future()
+        waiters.append(turn)
+        self.pending += 1
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.cancelled():
+                # release() may already have skipped over it and popped it
+                if turn in waiters:
+                    waiters.remove(turn)
+                self.pending -= 1
+            else:
+                # the turn was handed over just as the request was cancelled; pass it on
+                self.release(user_id)
+            raise
+
+    def release(self, user_id):
+        self.pending -= 1
+        if user_id is None:
+            return
+        waiters = self.queues[user_id]
+        while waiters:
+            turn = waiters.popleft()
+            # a cancelled request's future is done before its task gets to remove it
+            if not turn.done():
+                turn.set_result(None)
+                return
+        del self.queues[user_id]
+
+    def queued(self):
+        return self.pending - len(self.queues)
+
+class Turn:
+    __slots__ = ('actors', 'user_id')
+
+    def __init__(self, actors, user_id):
+        self.actors = actors
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        await self.actors.acquire(self.user_id)
+
+    async def __aexit__(self, *exc):
+        self.actors.release(self.user_id)
+
+actors = UserActors()
+
+async def request_user(req):
+    """The user a request acts for, from its decoded body; None if it has none or is malformed."""
+    cls = route_messages.get(req.path)
+    if cls is None or req.method != 'POST':
+        return None
+    try:
+        return (await read_message(req, cls)).user
+    except web.HTTPException:
+        return None
+
+# routes whose requests are admitted through `actors`; /ws frames take their own turns
+admitted_routes = {'/arrive', '/depart', '/dropped', '/command', '/commands'}
+
+@web.middleware
+async def admit_requests(req, handler):
+    """Run a user request as its user's turn, from body read to reply.
+
+    The handlers do not await once they have the body, so each would otherwise be
+    admitted and released within one step of the event loop and the limits would
+    never be reached. An admitted request yields to the loop once before running,
+    so every request that is ready at the same time is counted before any runs:
+    `pending` is then the real backlog, and a user's second request that arrives
+    with the first waits in (or is turned away from) that user's queue.
+    """
+    if req.path not in admitted_routes:
+        return await handler(req)
+    # None for /commands, and for a bad body, which the handler reports
+    async with actors.turn(await request_user(req)):
+        await asyncio.sleep(0)
+        return await handler(req)
+
+
 @routes.post('/newhub')
 async def register_with_hub_server(req: Request) -> Response:
     """Used by web UI to connect this domain to a hub server.
@@ -67,57 +942,13 @@ async def register_with_hub_server(req: Request) -> Response:
     global hub_server_url, domain_secret, domain_id
     hub_server_url = url
     
-    domain_items = [
-        {
-            "name": "i-card",
-            "description":"A UIUC admin's i-card,\nI wonder what this could open...",
-            "verb": {
-            },
-            "location": "lobby",
-        },
-        {
-            "name": "sheet-music",
-            "description":"A very old crinkly sheet of music with 'Bohemian Rhapsody' written on it. Hmm, the admin must've been a Queen fan",
-            "verb": {
-                # look/read music
-                # play music
-            },
-            "location": "closet",
-        },
-        {
-            "name": "drink-voucher",
-            "description":"A very olf starbucks drink voucher. 'This vocuher entitles you to one free drink of your choice'",
-            "verb": {
-                # use voucher
-            },
-            "location": "lounge",
-        },
-        {
-            "name": "peppermint-mocha",
-            "description":"A nice and steamy holiday drink. I can't wait to taste it.",
-            "verb": {
-                # drink
-            },
-            "location": "starbucks",
-        },
-        {
-            "name": "piano-key",
-            "description":"A black piano key... without the rest of the piano. That's odd.",
-            "verb": {},
-            "depth": 1,
-        },
-        {
-            "name": "rubber-gloves",
-            "description":"Arm length, bright-yellow, waterproof gloves.",
-            "verb": {},
-            "depth": 0,
-        },
-    ]
+    world = domain_state['world']
+    domain_items = [dict(item) for item in world.items]
     
     async with req.app.client.post(url+'/register', json={
           'url': whoami,
-          'name': "Sohum's Illini Union",
-          'description': "A snapshot of the UIUC Union and its many rooms.",
+          'name': world.name,
+          'description': world.description,
           'items': domain_items,
       }) as resp:
           data = await resp.json()
@@ -127,14 +958,17 @@ async def register_with_hub_server(req: Request) -> Response:
     try:
         # TO DO: store the url and the values in the returned data for later use
         domain_id, domain_secret = data['id'], data['secret']
-        # TO DO: clear any user/game state to its initial state
-        domain_state['users'].clear()
-        
+        # Sessions are kept: the catalog is rebuilt from the world's items, and ids the
+        # hub changed are remapped in every session (see reconcile_catalog).
+        catalog = ItemIndex()
         for i, item in enumerate(domain_items):
                 item_id = data['items'][i]
                 # Store in the domain_state dictionary, not domain_items
                 item['id'] = item_id
-                domain_state['items'].append(item) 
+                catalog.add(item)
+        reconcile_catalog(catalog, req.app.outbox)
+        if state_journal is not None:
+            state_journal.record_registration()
     except Exception as e:
         return json_response(data = {'error': f'Error during /newhub: {e}'}, status = 500)
     return json_response(data={'ok': 'woah registration is working'}, status=200)
@@ -143,46 +977,71 @@ async def register_with_hub_server(req: Request) -> Response:
 @routes.post('/arrive')
 async def handle_arrive(req: Request) -> Response:
     """Called by hub server each time a user enters or re-enters this domain."""
-    data = await req.json()
-    user_id = data['user']
-    incoming_dir = data['from']
+    msg = await read_message(req, ArriveMessage)
+    user_id = msg.user
+    incoming_dir = msg.origin
     global domain_secret
-    if data['secret'] != domain_secret:
-            return json_response(data = {'error': 'secrets do not match'}, status=  400)
+    if msg.secret != domain_secret:
+            return reply(req, {'error': 'secrets do not match'}, status=400)
     
-    if user_id not in domain_state['users'] or incoming_dir == 'login':
-        initialize_user(user_id)
+    user = domain_state['users'].get(user_id)
+    if msg.base is not None:
+        # a delta only applies to the inventory it was computed against
+        have = user.inventory_version if user is not None and incoming_dir != 'login' else None
+        if have is None or have != msg.base:
+            return reply(req, {'error': 'inventory version mismatch, send the full inventory',
+                               'version': have}, status=409)
+    if user is None or incoming_dir == 'login':
+        user = initialize_user(user_id)
+        analytics.start(user)
     else:
-        if incoming_dir == 'west':
-            domain_state['users'][user_id]['location'] = 'hallway'
-        elif incoming_dir == 'east':
-            domain_state['users'][user_id]['location'] = 'courtyard'
-        elif incoming_dir in ['south', 'direct']:
-            domain_state['users'][user_id]['location'] = 'lobby'
-        elif incoming_dir == 'north':
-            domain_state['users'][user_id]['location'] = 'lounge'
-        
+        domain_state['users'].relocate(user, domain_state['world'].entrances.get(incoming_dir, user.location))
+        analytics.enter(user.location)
     
-    # owned items (from this domain)
-    domain_state['users'][user_id]['owned'] = data['owned']
-    # carried items (from other domains)
-    domain_state['users'][user_id]['carried'] = data['carried']
-    # dropped items (these are items user left in this domain, with location info)
-    domain_state['users'][user_id]['dropped'] = data['dropped']
-    # prize items
-    domain_state['users'][user_id]['prize'] = data['prize']
+    if msg.base is None:
+        # owned items (from this domain)
+        user.owned = ItemIndex(msg.owned)
+        # carried items (from other domains)
+        user.carried = ItemIndex(msg.carried)
+        # dropped items (these are items user left in this domain, with location info)
+        user.dropped = ItemIndex(msg.dropped)
+        # prize items
+        user.prize = ItemIndex(msg.prize)
+    elif msg.changes:
+        apply_inventory_changes(user, msg.changes)
+    user.inventory_version = msg.version
+    user.view = None
+    domain_state['users'].touch(user_id)
 
-    return json_response(status=200)
+    sockets.push(user_id)
+    return reply(req, None if msg.version is None else {'version': msg.version})
+
+def apply_inventory_changes(user, changes):
+    """Apply a delta /arrive. Adding an item that is there replaces it and removing one
+    that is not is ignored, so changes the domain already made itself (a take, a drop)
+    and the hub reports back are harmless."""
+    for bucket_name, change in changes.items():
+        bucket = getattr(user, bucket_name)
+        for item_id in change['remove']:
+            bucket.pop(item_id)
+        for item in change['add']:
+            bucket.pop(item['id'])
+            bucket.add(item)
 
 @routes.post('/depart')
 async def handle_depart(req: Request) -> Response:
     """Called by hub server each time a user leaves this domain."""
-    data = await req.json()
-    user_id = data['user']
+    msg = await read_message(req, DepartMessage)
+    user_id = msg.user
     
-    domain_state['users'][user_id]['location'] = 'away'
+    user = domain_state['users'].get(user_id)
+    if user is not None:
+        domain_state['users'].relocate(user, AWAY)
+        domain_state['users'].touch(user_id)
+        # departed sessions are the first to be spilled to disk
+        domain_state['users'].park(user_id)
     
-    return json_response(status=200)
+    return reply(req, None)
     
     
 
@@ -192,324 +1051,1926 @@ async def register_with_hub_server(req: Request) -> Response:
     """Called by hub server each time a user drops an item in this domain.
     The return value must be JSON, and will be given as the location on subsequent /arrive calls
     """
-    data = await req.json()
-    user_id = data['user']
-    item_data = data['item']  # This is now a dictionary, e.g. {"name": "paper", ...}
+    msg = await read_message(req, DroppedMessage)
+    user_id = msg.user
+    item_data = msg.item  # This is now a dictionary, e.g. {"name": "paper", ...}
 
     global domain_secret
-    if data['secret'] != domain_secret:
-        return json_response(data={'error': 'secrets do not match'}, status=400)
+    if msg.secret != domain_secret:
+        return reply(req, {'error': 'secrets do not match'}, status=400)
 
-    user_loc = domain_state['users'][user_id]['location']
+    user = domain_state['users'].get(user_id)
+    if user is None:
+        return reply(req, {'error': 'unknown user, /arrive first'}, status=404)
+    user_loc = room_names[user.location]
 
     item_id = item_data['id']
     # Check that the item is known globally
     
-    if item_id not in [it['id'] for it in domain_state['items']]:
-        return json_response(data={'error': 'Item not recognized'}, status=400)
+    if item_id not in domain_state['items']:
+        return reply(req, {'error': 'Item not recognized'}, status=400)
+
+    item = user.carried.pop(item_id)
+    if item is not None:
+        # print('dropping item {} in {}'.format(item['id'], user_loc))
+        item['location'] = user_loc
+        user.dropped.add(item)
+    item = user.owned.pop(item_id)
+    if item is not None:
+        # print('dropping item {} in {}'.format(item['id'], user_loc))
+        user.move_item(domain_state['items'].by_id[item_id], user.location)
+    domain_state['users'].touch(user_id)
+
+    sockets.push(user_id)
+    return reply(req, user_loc)
+
+
+# Commands are dispatched through a table compiled once at startup instead of an
+# if/elif chain, so a command costs one hash lookup however many puzzles exist.
+# Puzzle handlers are keyed on (verb, object, room id); room None means any room.
+# The table is rebuilt when the world is reloaded.
+#
+# Handlers are the game engine and know nothing of aiohttp or the hub: they are
+# called as handler(user, user_id, command, effects) with the user's Session, return
+# the reply (see step) and append what the hub must be told to `effects`.
+command_specs = []
+command_table = {}
+verb_handlers = {}
+# verbs that have a handler; metrics label anything else 'other'
+known_verbs = set()
 
-    for item in domain_state['users'][user_id]["carried"]:
-        if item['id'] == item_id:
-            # print('dropping item {} in {}'.format(item['id'], user_loc))
-            item['location'] = user_loc
-            domain_state['users'][user_id]["dropped"].append(item)
-            domain_state['users'][user_id]["carried"].remove(item)
-    for item in domain_state['users'][user_id]["owned"]:
-        if item['id'] == item_id:
-            # print('dropping item {} in {}'.format(item['id'], user_loc))
-            item['location'] = user_loc
-            domain_state['users'][user_id]['items'].append(item)
-            domain_state['users'][user_id]["owned"].remove(item)
+def command(*words, room=None):
+    """Register a handler for an exact command, optionally only in one room."""
+    def register(handler):
+        command_specs.append((words, room, handler))
+        return handler
+    return register
 
-    return json_response(data=user_loc)
+def verb(name):
+    """Register the generic handler for a verb, used when no puzzle command matches."""
+    def register(handler):
+        verb_handlers[name] = handler
+        return handler
+    return register
+
+def compile_commands():
+    """Expand command_specs into command_table, one entry per (verb, object, room)."""
+    command_table.clear()
+    # any-room entries go in first so that room-specific ones override them
+    for words, room, handler in sorted(command_specs, key=lambda spec: spec[1] is not None):
+        if room is None:
+            rooms = domain_state['world'].rooms()
+        else:
+            rooms = [room_ids[room]] if room in room_ids else []
+        for r in rooms:
+            command_table[(words[0], ' '.join(words[1:]), r)] = handler
+    known_verbs.clear()
+    known_verbs.update(words[0] for words, _, _ in command_specs)
+    known_verbs.update(verb_handlers)
 
 
 @routes.post("/command")
 async def handle_command(req : Request) -> Response:
     """Handle hub-server commands"""    
-    data = await req.json()
-    user_id = data['user']
-    command = data['command']
-    
-    if user_id in domain_state['users'] and domain_state['users'][user_id]['location'] == 'away':
+    msg = await read_message(req, CommandMessage)
+    resp = run_command(req, msg.user, msg.command)
+    sockets.push(msg.user)
+    return resp
+
+# the most entries one /commands request may carry
+max_batch = 1000
+
+@routes.post("/commands")
+async def handle_commands(req : Request) -> Response:
+    """Run many users' commands in one request.
+
+    The body is a list of {"user": ..., "command": [...]} entries and the reply is a
+    list of {"status": ..., "text": ...} in the same order. Entries are grouped by
+    user and each user's commands run in the order given. The hub notifications they
+    cause go through the outbox, which coalesces them.
+    """
+    entries = await read_batch(req)
+    if len(entries) > max_batch:
+        return reply(req, {'error': 'at most {} entries per batch'.format(max_batch)}, status=413)
+    groups = group_batch(entries)
+    actors.check_capacity(len(groups))
+    results = [None] * len(entries)
+    await run_batch(req, entries, groups, results)
+    return reply(req, results)
+
+async def run_batch(req, entries, groups, results):
+    """Run the grouped entries one user at a time, storing each reply at its index."""
+    for user_id, indexes in groups.items():
+        try:
+            async with actors.turn(user_id):
+                for i in indexes:
+                    resp = run_command(req, user_id, entries[i].command)
+                    results[i] = {'status': resp.status, 'text': resp.text}
+        except (web.HTTPTooManyRequests, web.HTTPServiceUnavailable) as e:
+            for i in indexes:
+                results[i] = {'status': e.status, 'text': e.text}
+        else:
+            sockets.push(user_id)
+
+def group_batch(entries):
+    """Indexes of a batch's CommandMessages by user, in order."""
+    groups = {}
+    for i, entry in enumerate(entries):
+        groups.setdefault(entry.user, []).append(i)
+    return groups
+
+def run_command(req, user_id, command):
+    """Run one command for a user through step(); shared by /command and /commands."""
+    user = domain_state['users'].get(user_id)
+    if user is not None and user.location == AWAY:
         return Response(text = "User is away, cannot send commands until next /arrive.", status= 409)
     
-    if user_id not in domain_state['users']:
+    if user is None:
         return Response(text="You have to journey to this domain before you can send it commands.")
-        
-    if command == ['look', 'fishtank'] or command == ['look', 'fish', 'tank']:
-        if domain_state['users'][user_id]['location'] == 'lobby':
-            if domain_state['users'][user_id]['dynamic state']['fish tank'] == 'with card':
-                output = "You see a few fish swimming around, one seems to be bumping into something sticking out of the sand and rocks at the bottom. I wonder what that is. Maybe you should go fishing."
-            elif domain_state['users'][user_id]['dynamic state']['fish tank'] == 'card discovered':
-                output = "You see a few fish swimming around. There is an i-card at the bottom, try taking it."
-            elif domain_state['users'][user_id]['dynamic state']['fish tank'] == 'card taken':
-                output = "You see a few fish swimming around. You already took the i-card."
-            return Response(text = output)
-        
-    elif command == ['go','fishing']:
-        if domain_state['users'][user_id]['location'] == 'lobby':
-            if has_local_item_in_inventory('rubber-gloves', user_id):
-                if domain_state['users'][user_id]['dynamic state']['fish tank'] == 'with card':
-                    output = "You feel a plastic card sitting at the bottom, maybe it is an i-card."
-                    domain_state['users'][user_id]['dynamic state']['fish tank'] = 'card discovered'
-                elif domain_state['users'][user_id]['dynamic state']['fish tank'] == 'card discovered':
-                    output = "You feel a plastic card sitting at the bottom. Try taking the i-card."
-                    domain_state['users'][user_id]['dynamic state']['fish tank'] = 'card taken'
-                elif domain_state['users'][user_id]['dynamic state']['fish tank'] == 'card taken':
-                    output = "You already took the i-card"
-            else:
-                output = "Those fish look like the might bite you, maybe you should use some wear some gloves."
-            return Response(text = output)
-    
-    elif command == ['use', 'i-card', 'closet']:
-        if domain_state['users'][user_id]['location'] == 'hallway':
-            if has_local_item_in_inventory('i-card', user_id):
-                output = "You swipe the i-card and unlock the door to the closet"
-                domain_state['users'][user_id]['dynamic state']['closet door'] = 'unlocked'
-            else:
-                output = "You don't have an i-card, the closet remains locked."
-            return Response(text = output)
-                
-    elif command == ['go', 'west'] and domain_state['users'][user_id]['location'] == 'hallway':
-        if domain_state['users'][user_id]['dynamic state']['closet door'] == 'locked':
-            output = "The door is locked. There seems to be an i-card scanner on the door."
-        elif domain_state['users'][user_id]['dynamic state']['closet door'] == 'unlocked':
-            domain_state['users'][user_id]['location'] = 'closet'
-            output = room_info(domain_state['users'][user_id]['location'], user_id)
-        return Response(text = output)
     
-    elif command == ['go', 'east'] and domain_state['users'][user_id]['location'] == 'lobby':
-        output = "You speak with the staff at the help desk, they mention they got some new fish in the tank that you should take a look at. (Try to 'look fishtank') You return back to the lobby"
-        return Response(text = output)
+    if not command:
+        return Response(text = "I don't know how to do that.")
     
-    elif command == ['play', 'piano'] and domain_state['users'][user_id]['location'] == 'lounge':
-        if not has_local_item_in_inventory('sheet-music', user_id):
-            output = "You sit down, and you think of what to play... you realize you don't know any songs. You get up."
+    start = time.perf_counter()
+    # most commands (looks, bumping into walls) change nothing and need not be saved
+    before = (user.location, user.state, user.spill, user.changes)
+    output, effects = step(user, command, user_id)
+    apply_effects(req.app.outbox, user_id, effects)
+    if (user.location, user.state, user.spill, user.changes) != before:
+        domain_state['users'].touch(user_id)
+    observe(metrics['command_seconds'], command[0] if command[0] in known_verbs else 'other',
+            time.perf_counter() - start)
+    return text_response(output)
+
+def step(user, command, user_id=None):
+    """Run one command against a session and return (output, effects).
+
+    This is the whole game rule set: it reads the world and catalog, changes `user`,
+    counts moves and progress in `analytics`, and does no I/O, so it can run without
+    a server (see headless.py). `output` is the reply text, always a str. `effects`
+    lists what the hub must be told, as ('transfer', item id, location) and
+    ('score', score) tuples. `user_id` only labels trace events.
+    """
+    if not command:
+        return "I don't know how to do that.", []
+    world = domain_state['world']
+    if not world.has_room(user.location):
+        # the room was removed by a world reload
+        user.location = world.start
+    location = user.location
+    handler = command_table.get((command[0], ' '.join(command[1:]), location))
+    if handler is None:
+        handler = verb_handlers.get(command[0], unknown_command)
+    effects = []
+    output = handler(user, user_id, command, effects)
+    if user.location != location:
+        analytics.move(location, user.location)
+    for effect in effects:
+        if effect[0] == 'score':
+            analytics.finish(user)
+    return output, effects
+
+def apply_effects(outbox, user_id, effects):
+    """Queue a step's effects for the hub."""
+    for effect in effects:
+        if effect[0] == 'transfer':
+            outbox.transfer(user_id, effect[1], effect[2])
+        elif effect[0] == 'score':
+            outbox.score(user_id, effect[1])
+
+# Encoded reply bodies by reply text. Room renders come back from step() as the same
+# cached str objects, whose hash Python keeps, so answering a look costs a dict lookup
+# rather than an encode. Keyed by content, an entry is never stale; the dict is only
+# cleared when it fills.
+response_bodies = {}
+response_bodies_size = 10000
+
+def text_response(output):
+    body = response_bodies.get(output)
+    if body is None:
+        if len(response_bodies) >= response_bodies_size:
+            response_bodies.clear()
+        body = response_bodies[output] = output.encode()
+    return Response(body=body, content_type='text/plain', charset='utf-8')
+
+
+# Players can also connect over a WebSocket (GET /ws) and send commands for any
+# number of users as frames on one connection, without an HTTP request each. A
+# connection may play a user once it shows that user's play token, which the hub
+# hands out; it watches the users it plays, and is sent a user's room unprompted
+# when something else changes it: an item dropped through /dropped, an /arrive, a
+# command that came another way, or a world reload.
+#
+# Nothing is awaited to send to a connection. Replies and room updates go on the
+# connection's bounded outbox, which its own task drains, so a reader that falls
+# behind never holds up /command or anyone else's updates; once its outbox is full
+# it is closed instead.
+
+socket_queue_size = 256
+
+def play_token(user_id):
+    """The token a /ws client shows to play `user_id`: an HMAC of the user id keyed by
+    the domain secret, so only the hub, which shares the secret, can hand one out."""
+    key = (domain_secret or '').encode()
+    return hmac.new(key, str(user_id).encode(), hashlib.sha256).hexdigest()
+
+class PlayerConnection:
+    """One /ws connection; it answers in msgpack once a client sends binary frames."""
+    __slots__ = ('ws', 'users', 'allowed', 'binary', 'outbox', 'sender')
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.users = set()
+        # users this connection has shown a play token for
+        self.allowed = set()
+        self.binary = False
+        self.outbox = asyncio.Queue(socket_queue_size)
+        self.sender = asyncio.get_running_loop().create_task(self.drain())
+
+    async def drain(self):
+        while True:
+            data = await self.outbox.get()
+            try:
+                await self.send(data)
+            except ConnectionError:
+                return  # closing; its handler unwatches it
+
+    async def send(self, data):
+        if self.binary:
+            await self.ws.send_bytes(msgpack.packb(data))
+        elif orjson is not None:
+            await self.ws.send_str(orjson.dumps(data).decode())
         else:
-            if domain_state['users'][user_id]['dynamic state']['piano'] == 'missing key':
-                output = "You sit down, place your fingers to play, ding, ding, OW... it seems there is a missing key in the piano. Try using a piano key on the piano."
-            elif domain_state['users'][user_id]['dynamic state']['piano'] == 'fixed':
-                output = "You begin to play Bohemian Rhapsody, wow you are actually doing it. Ding, ding, thunk... that doesn't sound right. Seems like there might be something wrong inside the piano. Try opening it up."
-            
-        return Response(text = output)
-    
-    elif command == ['use', 'piano-key', 'piano'] and domain_state['users'][user_id]['location'] == 'lounge':
-        if domain_state['users'][user_id]['dynamic state']['piano'] == 'missing key':
-            if has_local_item_in_inventory('piano-key', user_id):
-                output = 'You place the piano key into the piano, now it looks ready to play'
-                domain_state['users'][user_id]['dynamic state']['piano'] = 'fixed'
+            await self.ws.send_str(json.dumps(data))
+
+class PlayerSockets:
+    """Open /ws connections and the users each one watches."""
+
+    def __init__(self):
+        self.connections = set()
+        # user id -> connections watching them
+        self.watchers = {}
+        self.frames = 0
+        self.pushed = 0
+        self.dropped = 0
+
+    def watch(self, conn, user_id):
+        conn.users.add(user_id)
+        self.watchers.setdefault(user_id, set()).add(conn)
+
+    def unwatch(self, conn, user_id):
+        conn.users.discard(user_id)
+        watchers = self.watchers.get(user_id)
+        if watchers is not None:
+            watchers.discard(conn)
+            if not watchers:
+                del self.watchers[user_id]
+
+    def close(self, conn):
+        self.connections.discard(conn)
+        for user_id in list(conn.users):
+            self.unwatch(conn, user_id)
+
+    def send(self, conn, data):
+        """Queue `data` for a connection; False if it is too far behind and is being closed."""
+        try:
+            conn.outbox.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.close(conn)
+        self.dropped += 1
+        conn.sender.cancel()
+        conn.sender = asyncio.get_running_loop().create_task(
+            conn.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'not reading fast enough'))
+        return False
+
+    def push(self, user_id, skip=None):
+        """Queue a user's current room for the connections watching them, except `skip`."""
+        watchers = self.watchers.get(user_id)
+        if not watchers:
+            return
+        user = domain_state['users'].get(user_id)
+        if user is None or not domain_state['world'].has_room(user.location):
+            return
+        event = {'event': 'room', 'user': user_id, 'room': room_names[user.location],
+                 'text': render_room(user, user_id)}
+        for conn in list(watchers):
+            if conn is not skip and self.send(conn, event):
+                self.pushed += 1
+
+    def push_all(self):
+        for user_id in list(self.watchers):
+            self.push(user_id)
+
+sockets = PlayerSockets()
+
+@routes.get('/ws')
+async def handle_websocket(req: Request) -> web.WebSocketResponse:
+    """Play many users over one WebSocket.
+
+    Each text frame is a JSON {"user": ..., "command": [...], "id": ...} and is
+    answered with {"id", "user", "status", "text"}, as /command would answer it; with
+    msgpack installed, binary frames carry msgpack. The first frame for a user must
+    carry that user's play token as "token", or it is answered with status 403. {"user": ..., "watch": false}
+    stops room updates for a user ({"watch": true} starts them without a command);
+    updates arrive as {"event": "room", "user", "room", "text"}. Frames are handled
+    in the order they arrive.
+    """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(req)
+    conn = PlayerConnection(ws)
+    sockets.connections.add(conn)
+    try:
+        async for frame in ws:
+            if frame.type == web.WSMsgType.TEXT:
+                body, content_type = frame.data, 'application/json'
+            elif frame.type == web.WSMsgType.BINARY:
+                body, content_type = frame.data, MSGPACK_TYPES[0]
+                conn.binary = msgpack is not None
             else:
-                output = 'You do not have a piano key to fix this. Maybe its somewhere else.'
-    
-    elif (command == ['look', 'piano'] or command == ['open', 'piano']) and domain_state['users'][user_id]['location'] == 'lounge':
-        if domain_state['users'][user_id]['dynamic state']['piano'] == 'fixed':
-            domain_state['users'][user_id]['dynamic state']['piano'] == 'open'
-            output = "You open the piano and see something inside... A voucher of some sort."
-        elif domain_state['users'][user_id]['dynamic state']['piano'] == 'missing key':
-            output = "You try to open the piano think maybe you should try playing it first before you break anything."
-        elif domain_state['users'][user_id]['dynamic state']['piano'] == 'open':
-            output = "The piano is already opedn, you see a voucher inside. Try to take the voucher."
-        return Response(text = output)
-    
-    elif (command == ['give', 'voucher'] or command == ['use','voucher','starbucks']) and domain_state['users'][user_id]['location'] == 'starbucks':
-        if has_local_item_in_inventory('voucher', user_id):
-            if domain_state['users'][user_id]['dynamic state']['starbucks'] == 'has drink':
-                output = "You give the voucher to the barista, they look confused for a second, but then get to work. For some reason they getup on a ladder and pull something from the ceiling tile while making your drink. Hmm, odd. After a few minutes, the barista places a steamy peppermint-mocha on the table. Yay!"
-                domain_state['users'][user_id]['dynamic state']['starbucks'] == 'drink served'
-                for i in range(len(domain_state['users'][user_id]['owned'])):
-                    if domain_state['users'][user_id]['owned'][i]['name'] == 'voucher':
-                        del domain_state['users'][user_id]['owned'][i]
-        elif domain_state['users'][user_id]['dynamic state']['starbucks'] == 'has drink':
-            output = "Hmm the peppermint-mocha does look good, but you don't have any money, maybe theres something else that can help you get a drink."
-        elif domain_state['users'][user_id]['dynamic state']['starbucks'] == 'drink served':
-            output = "Your drink has been served, pickup your steamy peppermint-mocha before it get cold."
-            domain_state['users'][user_id]['dynamic state']['starbucks'] == 'drink taken'
-        elif domain_state['users'][user_id]['dynamic state']['starbucks'] == 'drink taken':
-            output = "You have already taken the peppermint-mocha, try to drink it."
-        
-        return Response(text = output)
-    
-    elif command == ['drink', 'starbucks'] or command == ['drink', 'peppermint-mocha']:
-        if has_local_item_in_inventory('peppermint-mocha', user_id):
-            output = "It smells so good... *sip*... yum- EW. Something doesn't taste right about this. *you open the coffe cup and see something floting inside* WHAT IS THIS. *you immediately drop your drink, spilling the mocha and the foreign object on the ground."
-            domain_state['users'][user_id]['dynamic state']['drink'] = "investigated"
-            domain_state['users'][user_id]['dynamic state']['drink spill location'] = domain_state['users'][user_id]['location']
+                continue
+            sockets.frames += 1
+            if not sockets.send(conn, await socket_frame(req, conn, body, content_type)):
+                await conn.sender  # closing it
+                break
+    finally:
+        # a connection closed for being slow is already gone, and its sender is closing it
+        if conn in sockets.connections:
+            sockets.close(conn)
+            conn.sender.cancel()
+    return ws
+
+async def socket_frame(req, conn, body, content_type):
+    """The reply to one /ws frame."""
+    try:
+        msg = SocketMessage.decode(decode_bytes(body, content_type))
+    except ValueError as e:
+        return {'id': None, 'user': None, 'status': 400, 'text': 'bad /ws message: {}'.format(e)}
+    except web.HTTPException as e:
+        return {'id': None, 'user': None, 'status': e.status, 'text': e.text}
+    if msg.user not in conn.allowed:
+        # compare_digest only takes ASCII strings; anything else is not a token we gave out
+        if (msg.token is None or not msg.token.isascii()
+                or not hmac.compare_digest(msg.token, play_token(msg.user))):
+            return {'id': msg.id, 'user': msg.user, 'status': 403, 'text': 'no valid play token for this user'}
+        conn.allowed.add(msg.user)
+    if msg.watch is False:
+        sockets.unwatch(conn, msg.user)
+    else:
+        sockets.watch(conn, msg.user)
+    if msg.command is None:
+        return {'id': msg.id, 'user': msg.user, 'status': 200, 'text': ''}
+    if worker_peers and shard_of(msg.user) != worker_index:
+        # the owner answers; its room updates only reach connections on that worker
+        try:
+            async with req.app.client.post(worker_peers[shard_of(msg.user)] + '/command',
+                                           json={'user': msg.user, 'command': msg.command},
+                                           headers={'X-Shard-Forwarded': internal_token}) as resp:
+                return {'id': msg.id, 'user': msg.user, 'status': resp.status, 'text': await resp.text()}
+        except (ClientError, asyncio.TimeoutError) as e:
+            return {'id': msg.id, 'user': msg.user, 'status': 502, 'text': 'worker unavailable: {!r}'.format(e)}
+    try:
+        async with actors.turn(msg.user):
+            resp = run_command(req, msg.user, msg.command)
+    except (web.HTTPTooManyRequests, web.HTTPServiceUnavailable) as e:
+        return {'id': msg.id, 'user': msg.user, 'status': e.status, 'text': e.text}
+    sockets.push(msg.user, skip=conn)
+    return {'id': msg.id, 'user': msg.user, 'status': resp.status, 'text': resp.text}
+
+async def close_sockets(app):
+    for conn in list(sockets.connections):
+        await conn.ws.close(code=WSCloseCode.GOING_AWAY, message=b'server shutdown')
+
+
+@command('look', 'fishtank', room='lobby')
+@command('look', 'fish', 'tank', room='lobby')
+def look_fishtank(user, user_id, command, effects):
+    stage = fish_tank.stage(user)
+    if stage == CARD_HIDDEN:
+        output = "You see a few fish swimming around, one seems to be bumping into something sticking out of the sand and rocks at the bottom. I wonder what that is. Maybe you should go fishing."
+    elif stage == CARD_DISCOVERED:
+        output = "You see a few fish swimming around. There is an i-card at the bottom, try taking it."
+    elif stage == CARD_TAKEN:
+        output = "You see a few fish swimming around. You already took the i-card."
+    return output
+
+@command('go', 'fishing', room='lobby')
+def go_fishing(user, user_id, command, effects):
+    if has_local_item_in_inventory('rubber-gloves', user, user_id):
+        stage = fish_tank.stage(user)
+        if stage == CARD_HIDDEN:
+            output = "You feel a plastic card sitting at the bottom, maybe it is an i-card."
+        elif stage == CARD_DISCOVERED:
+            output = "You feel a plastic card sitting at the bottom. Try taking the i-card."
+        elif stage == CARD_TAKEN:
+            output = "You already took the i-card"
+        fish_tank.fire(user, 'fish')
+    else:
+        output = "Those fish look like the might bite you, maybe you should use some wear some gloves."
+    return output
+
+@command('use', 'i-card', 'closet', room='hallway')
+def use_icard_closet(user, user_id, command, effects):
+    if has_local_item_in_inventory('i-card', user, user_id):
+        output = "You swipe the i-card and unlock the door to the closet"
+        closet_door.fire(user, 'swipe')
+    else:
+        output = "You don't have an i-card, the closet remains locked."
+    return output
+
+@command('go', 'west', room='hallway')
+def enter_closet(user, user_id, command, effects):
+    if closet_door.stage(user) == CLOSET_LOCKED:
+        output = "The door is locked. There seems to be an i-card scanner on the door."
+    else:
+        user.location = CLOSET
+        return render_room(user, user_id)
+    return output
+
+@command('go', 'east', room='lobby')
+def visit_help_desk(user, user_id, command, effects):
+    output = "You speak with the staff at the help desk, they mention they got some new fish in the tank that you should take a look at. (Try to 'look fishtank') You return back to the lobby"
+    return output
+
+@command('play', 'piano', room='lounge')
+def play_piano(user, user_id, command, effects):
+    if not has_local_item_in_inventory('sheet-music', user, user_id):
+        output = "You sit down, and you think of what to play... you realize you don't know any songs. You get up."
+    else:
+        if piano.stage(user) == PIANO_MISSING_KEY:
+            output = "You sit down, place your fingers to play, ding, ding, OW... it seems there is a missing key in the piano. Try using a piano key on the piano."
         else:
-            output = "You have not picked up the drink yet."
-        
-        return Response(text = output)
-    
-    elif command == ['go', 'south'] and domain_state['users'][user_id]['location'] == 'courtyard':
-        output = "You bravely step on the stage. After a few moments you begin to a panic a little. You start to sing 'Dancing Queen'... *screech* your voice cracks and you rush back into the courtyard, people staring at you."
-        return Response(text = output)
+            output = "You begin to play Bohemian Rhapsody, wow you are actually doing it. Ding, ding, thunk... that doesn't sound right. Seems like there might be something wrong inside the piano. Try opening it up."
         
-    elif command[0] == "look":
-        if len(command) > 1:
-            for item in domain_state['users'][user_id]['owned']:
-                if command[1] == item['name'] or command[1] == item['id'] :
-                    output = item['description']
-                    return Response(text = output)
-            for item in domain_state['users'][user_id]['carried']:
-                if command[1] == item['name'] or command[1] == item['id'] :
-                    output = item['description']
-                    return Response(text = output)
-            return Response(text = "I don't know how to do that.")
+    return output
+
+@command('use', 'piano-key', 'piano', room='lounge')
+def use_piano_key(user, user_id, command, effects):
+    if piano.stage(user) == PIANO_MISSING_KEY:
+        if has_local_item_in_inventory('piano-key', user, user_id):
+            output = 'You place the piano key into the piano, now it looks ready to play'
+            piano.fire(user, 'insert key')
         else:
-            output = room_info(domain_state['users'][user_id]['location'], user_id)
-            return Response(text = output)
-        
-    elif command[0] == "take":
-        #from room 
-        for source, destination in [('items','owned'),('dropped', 'carried'),('prize','carried')]:
-            # print('using source {} and destintion {} to move {}'.format(source, destination, command[1]))
-            
-            for item in domain_state['users'][user_id][source]:
-                if item['name'] == command[1] or item['id'] == command[1]:
-                    if item.get('depth', -1) == 2 and source == 'prize' and domain_state['users']['dynamic state']['drink spilled location'] == 'not spilled':
-                        break
-                    item['location'] = 'inventory'
-                    domain_state['users'][user_id][destination].append(item)
-                    domain_state['users'][user_id][source].remove(item)
-                    async with req.app.client.post(hub_server_url+'/transfer', json={ 
-                        "domain": domain_id # your domain's ID as given during /newhub
-                        ,"secret": domain_secret # your domain's secret as given during /newhub
-                        ,"user": user_id   # the user ID as given in /arrive
-                        ,"item": item['id']   # a numerical item ID
-                        ,"to": 'inventory'     # where you want the item to go
-                    }) as resp:
-                        data = await resp.json()
-                        if 'error' in data:
-                            return json_response(status=resp.status, data=data)
-                    if item.get('depth', -1) == 2:
-                        async with req.app.client.post(hub_server_url+'/score', json={ 
-                            "domain": domain_id # your domain's ID as given during /newhub
-                            ,"secret": domain_secret # your domain's secret as given during /newhub
-                            ,"user": user_id   # the user ID as given in /arrive
-                            ,"score": 1.0     # where you want the item to go
-                        }) as resp:
-                            data = await resp.json()
-                            if 'error' in data:
-                                return json_response(status=resp.status, data=data)
-                        return Response(text = "You have taken the {}. You have finished this domain, congrats!".format(command[1]))
-                    return Response(text = "You have taken the {}".format(command[1]))
-
-                
-        return Response(text = "There's no {} here to take".format(command[1]))
+            output = 'You do not have a piano key to fix this. Maybe its somewhere else.'
+        return output
+    return "I don't know how to do that."
+
+@command('look', 'piano', room='lounge')
+@command('open', 'piano', room='lounge')
+def open_piano(user, user_id, command, effects):
+    stage = piano.stage(user)
+    if stage == PIANO_FIXED:
+        piano.fire(user, 'open')
+        output = "You open the piano and see something inside... A voucher of some sort."
+    elif stage == PIANO_MISSING_KEY:
+        output = "You try to open the piano think maybe you should try playing it first before you break anything."
+    elif stage == PIANO_OPEN:
+        output = "The piano is already opedn, you see a voucher inside. Try to take the voucher."
+    return output
+
+@command('give', 'voucher', room='starbucks')
+@command('give', 'drink-voucher', room='starbucks')
+@command('use', 'voucher', 'starbucks', room='starbucks')
+@command('use', 'drink-voucher', 'starbucks', room='starbucks')
+def use_voucher(user, user_id, command, effects):
+    stage = starbucks.stage(user)
+    if stage == HAS_DRINK:
+        if has_local_item_in_inventory('drink-voucher', user, user_id):
+            output = "You give the voucher to the barista, they look confused for a second, but then get to work. For some reason they getup on a ladder and pull something from the ceiling tile while making your drink. Hmm, odd. After a few minutes, the barista places a steamy peppermint-mocha on the table. Yay!"
+            starbucks.fire(user, 'serve')
+            for item_id in list(domain_state['items'].ids_named('drink-voucher')):
+                user.owned.pop(item_id)
+            user.changes += 1
+        else:
+            output = "Hmm the peppermint-mocha does look good, but you don't have any money, maybe theres something else that can help you get a drink."
+    elif stage == DRINK_SERVED:
+        output = "Your drink has been served, pickup your steamy peppermint-mocha before it get cold."
+        starbucks.fire(user, 'pick up')
+    else:
+        output = "You have already taken the peppermint-mocha, try to drink it."
     
-    elif command[0] == "drop":
-        
-        # print('checking user inventory to drop {}: {}'.format(command[1],domain_state['users'][user_id]["carried"]))
-        for destination, source in [('items','owned'),('dropped', 'carried')]:
-            for item in domain_state['users'][user_id][source]:
-                if item['name'] == command[1]:
-                    # print('dropping item {} in {}'.format(item['name'], domain_state['users'][user_id]['location']))
-                    item['location'] = domain_state['users'][user_id]['location']
-                    domain_state['users'][user_id][destination].append(item)
-                    domain_state['users'][user_id][source].remove(item)
-                    # print('after command drop owned: {} \nitems: {}'.format(domain_state['users'][user_id]['owned'],domain_state['users'][user_id]['items']))
-
-                    return Response(text = domain_state['users'][user_id]['location'])
-    elif command[0] == "go":
-        
-        direction = command[1]
-        if direction in domain_state['rooms'][domain_state['users'][user_id]['location']].keys():
-            destination = domain_state['rooms'][domain_state['users'][user_id]['location']][direction]
-            if destination == 'exit':
-                return Response(text = "$journey east")
-            domain_state['users'][user_id]['location'] = destination
-            output = room_info(domain_state['users'][user_id]['location'], user_id)
-            return Response(text = output)
-        return Response(text = "You can't go that way from here.")
+    return output
+
+@command('drink', 'starbucks')
+@command('drink', 'peppermint-mocha')
+def drink_mocha(user, user_id, command, effects):
+    if has_local_item_in_inventory('peppermint-mocha', user, user_id):
+        output = "It smells so good... *sip*... yum- EW. Something doesn't taste right about this. *you open the coffe cup and see something floting inside* WHAT IS THIS. *you immediately drop your drink, spilling the mocha and the foreign object on the ground."
+        drink.fire(user, 'spill')
+        user.spill = user.location
+        user.view = None
+    else:
+        output = "You have not picked up the drink yet."
     
+    return output
 
-            
+@command('go', 'south', room='courtyard')
+def sing_on_stage(user, user_id, command, effects):
+    output = "You bravely step on the stage. After a few moments you begin to a panic a little. You start to sing 'Dancing Queen'... *screech* your voice cracks and you rush back into the courtyard, people staring at you."
+    return output
+
+
+@verb('look')
+def look(user, user_id, command, effects):
+    if len(command) > 1:
+        item = user.owned.find(command[1]) or user.carried.find(command[1])
+        if item is not None:
+            output = item['description']
+            return output
+        return "I don't know how to do that."
+    else:
+        return render_room(user, user_id)
+
+@verb('take')
+def take(user, user_id, command, effects):
+    if len(command) < 2:
+        return "I don't know how to do that."
+    #from room 
+    item = user.find_world_item(command[1])
+    if item is not None:
+        user.move_item(item, INVENTORY)
+        user.owned.add(item)
     else:
-        action_item = command[1] if len(command) > 1 else None
-        action_verb = command[0]
-        print('carried items: {}'.format(domain_state['users'][user_id]['carried']))
-        print('owned items: {}'.format(domain_state['users'][user_id]['owned']))
-        for lst in ["carried", "owned"]:
-            for item in domain_state['users'][user_id][lst]:
-                if action_item == item['name'] or action_item == item['id']:
-                    if action_verb in item['verb']:
-                        output = item['verb'][action_verb]
-                        if output:
-                            return Response(text = output)
-    return Response(text = "I don't know how to do that.")
+        for source in (user.dropped, user.prize):
+            item = source.find(command[1])
+            if item is None:
+                continue
+            if item.get('depth', -1) == 2 and source is user.prize and user.spill is None:
+                item = None
+                continue
+            item['location'] = 'inventory'
+            source.pop(item['id'])
+            user.view = None
+            user.carried.add(item)
+            user.changes += 1
+            break
+
+    if item is not None:
+        # the hub is told in the background, see apply_effects
+        effects.append(('transfer', item['id'], 'inventory'))
+        if item.get('depth', -1) == 2:
+            effects.append(('score', 1.0))
+            return "You have taken the {}. You have finished this domain, congrats!".format(command[1])
+        return "You have taken the {}".format(command[1])
+
+    return "There's no {} here to take".format(command[1])
+
+@verb('drop')
+def drop(user, user_id, command, effects):
+    if len(command) < 2:
+        return "I don't know how to do that."
+    # print('checking user inventory to drop {}: {}'.format(command[1],user.carried))
+    item = user.owned.find(command[1])
+    if item is not None:
+        # print('dropping item {} in {}'.format(item['name'], user.location))
+        user.owned.pop(item['id'])
+        user.changes += 1
+        if item['id'] in domain_state['items']:
+            user.move_item(domain_state['items'].by_id[item['id']], user.location)
+        return room_names[user.location]
+    item = user.carried.find(command[1])
+    if item is not None:
+        item['location'] = room_names[user.location]
+        user.carried.pop(item['id'])
+        user.dropped.add(item)
+        user.changes += 1
+        return room_names[user.location]
+    return "I don't know how to do that."
+
+@verb('go')
+def go(user, user_id, command, effects):
+    if len(command) < 2:
+        return "You can't go that way from here."
+    direction = direction_ids.get(command[1])
+    row = domain_state['world'].exits[user.location]
+    if direction is not None and direction < len(row) and row[direction] is not None:
+        destination = row[direction]
+        if isinstance(destination, str):
+            return destination
+        user.location = destination
+        return render_room(user, user_id)
+    return "You can't go that way from here."
+
+def unknown_command(user, user_id, command, effects):
+    """Fallback for verbs without a handler: use the verb text of a held item, if any."""
+    action_item = command[1] if len(command) > 1 else None
+    action_verb = command[0]
+    if tracer.wants(user_id):
+        tracer.emit('command.unknown', user_id, command=command,
+                    carried=list(user.carried.by_id), owned=list(user.owned.by_id))
+    for bucket in (user.carried, user.owned):
+        item = bucket.find(action_item)
+        if item is not None and action_verb in item['verb']:
+            output = item['verb'][action_verb]
+            if output:
+                return output
+    return "I don't know how to do that."
+
+compile_commands()
 
 
 def initialize_user(user_id):
     # Each user gets their own session of items, furniture, etc.
     # This ensures one user's actions don't affect another.
-    domain_state['users'][user_id] = {
-        'location': 'lobby',
-        'dynamic state': {
-            'fish tank': 'with card',
-            'piano': 'missing key',
-            'closet door': 'locked',
-            'starbucks': 'has drink',
-            'drink': 'undiscovered',
-            'drink spill location': 'not spilled',
-        },
-        'items': [],
-        'owned': [],
-        'carried': [],
-        'dropped': [],
-        'prize': [],
-    }
-    for item in domain_state['items']:
-        domain_state['users'][user_id]['items'].append(item)
+    user = domain_state['users'][user_id] = Session()
+    return user
 
-def room_info(location, user_id):
-    output = domain_state['rooms'][location]['description']
-    
-    room_items = items_in_room(location, user_id)
-    for item in room_items:
-        output += '\nThere is a {} <sub>{}</sub> here.'.format(item["name"], item['id'])
-    
-    return output
+def room_info(location, user, user_id=None):
+    lines = [domain_state['world'].descriptions[location]]
+    for item in items_in_room(location, user, user_id):
+        lines.append('There is a {} <sub>{}</sub> here.'.format(item["name"], item['id']))
+    return '\n'.join(lines)
+
+
+# Rendered rooms are cached as text, shared by every user whose view of the room is
+# the same; text_response keeps their encoded bodies. A session's view id names the
+# parts of its state a render depends on and is only recomputed after that state
+# changes (Session.view is reset), so a look or a move is a single dict lookup on
+# (room, view id).
+#
+# When the world or the catalog changes, every render and view id is stale at once;
+# when the cache fills, both are dropped together too. invalidate_views() forgets
+# them all. View ids only ever increase, so a session's view is stale exactly when
+# it is below view_floor, and sessions need not be visited.
+render_cache = {}
+render_cache_size = 10000
+view_ids = {}
+view_floor = 0
+render_stats = {'hits': 0, 'misses': 0}
 
-def items_in_room(location, user_id):
+def invalidate_views():
+    global view_floor
+    view_floor += len(view_ids)
+    view_ids.clear()
+    render_cache.clear()
+
+def view_id(user):
+    if user.view is None or user.view < view_floor:
+        key = (
+            tuple(sorted(user.moved.items())) if user.moved else (),
+            user.state & render_state_mask,
+            user.spill,
+            tuple((item['id'], item['name'], item.get('depth', -1)) for item in user.prize),
+        )
+        user.view = view_ids.get(key)
+        if user.view is None:
+            user.view = view_ids[key] = view_floor + len(view_ids)
+    return user.view
+
+def render_room(user, user_id=None):
+    """room_info for a user's current room, from the cache when possible."""
+    if len(render_cache) >= render_cache_size:
+        # view ids would otherwise pile up for good; every new one comes with a render
+        invalidate_views()
+    key = (user.location, view_id(user))
+    text = render_cache.get(key)
+    if text is None:
+        render_stats['misses'] += 1
+        text = render_cache[key] = room_info(user.location, user, user_id)
+    else:
+        render_stats['hits'] += 1
+    return text
+
+def items_in_room(location, user, user_id=None):
     """Return a list of items present in the given location."""
     output = []
-    for item in domain_state['users'][user_id]['items']:
-        if item.get('location', None) == location:
-            if item['name'] == 'i-card' and domain_state['users'][user_id]['dynamic state']['fish tank'] in ['with card', 'card taken']:
-                print('i-card not discovered yet')
-            elif item['name'] == 'drink-voucher' and domain_state['users'][user_id]['dynamic state']['piano'] in ['fixed', 'missing key']:
-                print('voucher not discovered yet')
+    for item in domain_state['items']:
+        if user.item_location(item) == location:
+            if item['name'] == 'i-card' and fish_tank.stage(user) != CARD_DISCOVERED:
+                tracer.trace('item.hidden', user_id, item='i-card')
+            elif item['name'] == 'drink-voucher' and piano.stage(user) != PIANO_OPEN:
+                tracer.trace('item.hidden', user_id, item='drink-voucher')
             else:
                 output.append(item)
             
     
-    # print('items in room, prize list: {}'.format(domain_state['users'][user_id]['prize']))
-    if domain_state['users'][user_id]['location'] == domain_state['users'][user_id]['dynamic state']['drink spill location']:
-        for item in domain_state['users'][user_id]['prize']:
-            if item.get('depth', -1) == 2:
-                output.append(item)
-    if domain_state['users'][user_id]['location'] == 'closet':
-        for item in domain_state['users'][user_id]['prize']:
-            if item.get('depth', -1) == 1:
-                output.append(item)
-    if domain_state['users'][user_id]['location'] == 'hallway':
-        for item in domain_state['users'][user_id]['prize']:
-            if item.get('depth', -1) == 0:
-                output.append(item)
+    # print('items in room, prize list: {}'.format(user.prize))
+    # prizes show up at increasing depth: hallway, closet, then wherever the drink spilled
+    spilled_here = user.location == user.spill
+    for item in user.prize:
+        depth = item.get('depth', -1)
+        if ((depth == 0 and user.location == HALLWAY) or (depth == 1 and user.location == CLOSET)
+                or (depth == 2 and spilled_here)):
+            output.append(item)
     return output
 
-def has_local_item_in_inventory(item_name, user_id):
+def has_local_item_in_inventory(item_name, user, user_id=None):
     # print('looking for {} in inventory'.format(item_name))
-    # print('locally owned items are {}'.format(domain_state['users'][user_id]['owned']))
-    item_id = [it['id'] for it in domain_state['items'] if it['name'] == item_name]
-    for it in domain_state['users'][user_id]['owned']:
-        if it['id'] in item_id:
-            print('found it')
+    # print('locally owned items are {}'.format(user.owned))
+    owned = user.owned
+    for item_id in domain_state['items'].ids_named(item_name):
+        if item_id in owned:
+            tracer.trace('inventory.found', user_id, item=item_name)
             return True
     # print('didnt find it')
     return False
 
 
+class HubOutbox:
+    """Background queue of notifications for the hub server (/transfer and /score).
+
+    Commands apply their changes locally and enqueue a notification, so a slow hub
+    never holds up a player's command. A worker task sends queued notifications in
+    concurrent batches over the shared ClientSession. Notifications with the same key
+    are coalesced while queued (the latest one wins), failed sends are retried with
+    exponential backoff, and after `failure_threshold` consecutive failures a circuit
+    breaker stops calling the hub for `reset_timeout` seconds. Every notification
+    put() ends up counted once in `sent`, `dropped` or `coalesced` (replaced by a
+    newer one with the same key), unless it is still pending.
+    """
+
+    def __init__(self, client, batch_size=64, max_pending=100000, max_attempts=5,
+                 base_delay=0.1, max_delay=5.0, failure_threshold=5, reset_timeout=10.0):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # key -> [path, payload, attempts]; dicts keep insertion order, so this is a FIFO
+        self.pending = {}
+        self.failures = 0
+        self.open_until = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def transfer(self, user_id, item_id, to):
+        self.put(('transfer', user_id, item_id), '/transfer', {'user': user_id, 'item': item_id, 'to': to})
+
+    def score(self, user_id, score):
+        self.put(('score', user_id), '/score', {'user': user_id, 'score': score})
+
+    def put(self, key, path, payload):
+        if key in self.pending:
+            self.pending[key][1] = payload
+            self.coalesced += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            # oldest first: the hub has been unreachable for a long time anyway
+            del self.pending[next(iter(self.pending))]
+            self.dropped += 1
+        self.pending[key] = [path, payload, 0]
+        self.wakeup.set()
+
+    def remap(self, mapping):
+        """Rename catalog item ids in queued /transfer notifications."""
+        pending = {}
+        for key, entry in self.pending.items():
+            if key[0] == 'transfer' and key[2] in mapping:
+                key = ('transfer', key[1], mapping[key[2]])
+                entry[1] = dict(entry[1], item=key[2])
+            pending[key] = entry
+        self.pending = pending
+
+    def breaker_open(self):
+        return self.open_until > asyncio.get_running_loop().time()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=2.0):
+        """Give queued notifications `timeout` seconds to drain, then stop the worker."""
+        if self.task is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending and loop.time() < deadline and not self.breaker_open():
+            await asyncio.sleep(0.05)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            if self.open_until > loop.time():
+                await asyncio.sleep(self.open_until - loop.time())
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                key = next(iter(self.pending))
+                batch.append((key, self.pending.pop(key)))
+            results = await asyncio.gather(*(self.send(path, payload) for _, (path, payload, _) in batch))
+            failed = False
+            for (key, entry), ok in zip(batch, results):
+                if ok:
+                    self.sent += 1
+                    continue
+                failed = True
+                entry[2] += 1
+                if entry[2] >= self.max_attempts:
+                    tracer.trace('hub.gave_up', key[1], path=entry[0], attempts=entry[2])
+                    self.dropped += 1
+                elif key in self.pending:
+                    # a newer notification with the same key supersedes the failed one
+                    self.coalesced += 1
+                else:
+                    self.pending[key] = entry
+            if failed:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.open_until = loop.time() + self.reset_timeout
+                else:
+                    await asyncio.sleep(min(self.max_delay, self.base_delay * 2 ** (self.failures - 1)))
+            else:
+                self.failures = 0
+
+    async def send(self, path, payload):
+        """POST one notification; False means it should be retried."""
+        body = dict(payload, domain=domain_id, secret=domain_secret)
+        start = time.perf_counter()
+        ok = False
+        try:
+            async with self.client.post(hub_server_url + path, json=body) as resp:
+                data = await resp.json(content_type=None)
+                if resp.status >= 500:
+                    return False
+                ok = True
+                if isinstance(data, dict) and 'error' in data:
+                    # the hub understood and refused; retrying would not help
+                    tracer.trace('hub.refused', payload['user'], path=path, error=data['error'])
+                    ok = False
+                return True
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            return False
+        finally:
+            observe(metrics['hub_seconds'], path, time.perf_counter() - start)
+            if not ok:
+                metrics['hub_errors'][path] = metrics['hub_errors'].get(path, 0) + 1
+
+# Metrics, served at /metrics in the Prometheus text format. Everything is a counter
+# or a fixed-bucket histogram updated in place, cheap enough to leave on all the
+# time. In multi-worker mode each worker keeps its own; scrape their private ports.
+class Histogram:
+    """Latency histogram with fixed bucket bounds, in seconds."""
+    __slots__ = ('counts', 'total', 'count')
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (None,), self.counts):
+            cumulative += n
+            le = 'le="{}"'.format('+Inf' if bound is None else bound)
+            lines.append('{}_bucket{{{}}} {}'.format(name, ','.join(labels + [le]), cumulative))
+        suffix = '{{{}}}'.format(','.join(labels)) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, suffix, self.total))
+        lines.append('{}_count{} {}'.format(name, suffix, self.count))
+        return lines
+
+metrics = {
+    'requests': {},          # (route, status) -> count
+    'request_seconds': {},   # route -> Histogram
+    'command_seconds': {},   # verb -> Histogram
+    'hub_seconds': {},       # hub path -> Histogram
+    'hub_errors': {},        # hub path -> count
+    'loop_lag_seconds': Histogram(),
+}
+
+def observe(histograms, key, seconds):
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+def label(name, value):
+    return '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+@web.middleware
+async def record_metrics(req, handler):
+    """Count requests and time them per route."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = req.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        key = (route, status)
+        metrics['requests'][key] = metrics['requests'].get(key, 0) + 1
+        observe(metrics['request_seconds'], route, time.perf_counter() - start)
+
+async def monitor_loop_lag(interval=0.25):
+    """Measure how late the event loop wakes up a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics['loop_lag_seconds'].observe(max(0.0, loop.time() - start - interval))
+
+@routes.get('/metrics')
+async def handle_metrics(req: Request) -> Response:
+    """Prometheus scrape endpoint."""
+    lines = [
+        '# HELP domain_requests_total HTTP requests handled, by route and status.',
+        '# TYPE domain_requests_total counter',
+    ]
+    for (route, status), n in sorted(metrics['requests'].items()):
+        lines.append('domain_requests_total{{{},{}}} {}'.format(label('route', route), label('status', status), n))
+    lines += [
+        '# HELP domain_request_duration_seconds Time to handle a request, by route.',
+        '# TYPE domain_request_duration_seconds histogram',
+    ]
+    for route, histogram in sorted(metrics['request_seconds'].items()):
+        lines += histogram.render('domain_request_duration_seconds', [label('route', route)])
+    lines += [
+        '# HELP domain_command_duration_seconds Time to run a /command, by verb.',
+        '# TYPE domain_command_duration_seconds histogram',
+    ]
+    for verb_name, histogram in sorted(metrics['command_seconds'].items()):
+        lines += histogram.render('domain_command_duration_seconds', [label('verb', verb_name)])
+    lines += [
+        '# HELP domain_hub_call_duration_seconds Time of calls to the hub server, by path.',
+        '# TYPE domain_hub_call_duration_seconds histogram',
+    ]
+    for path, histogram in sorted(metrics['hub_seconds'].items()):
+        lines += histogram.render('domain_hub_call_duration_seconds', [label('path', path)])
+    lines += [
+        '# HELP domain_hub_call_errors_total Failed or refused calls to the hub server, by path.',
+        '# TYPE domain_hub_call_errors_total counter',
+    ]
+    for path, n in sorted(metrics['hub_errors'].items()):
+        lines.append('domain_hub_call_errors_total{{{}}} {}'.format(label('path', path), n))
+    lines += [
+        '# HELP domain_event_loop_lag_seconds How late the event loop ran a timer.',
+        '# TYPE domain_event_loop_lag_seconds histogram',
+    ]
+    lines += metrics['loop_lag_seconds'].render('domain_event_loop_lag_seconds', [])
+
+    store = domain_state['users']
+    away = store.away
+    lines += [
+        '# HELP domain_sessions Sessions by where they are held; resident ones split by active/away.',
+        '# TYPE domain_sessions gauge',
+        'domain_sessions{{state="active"}} {}'.format(len(store.resident) - away),
+        'domain_sessions{{state="away"}} {}'.format(away),
+        'domain_sessions{{state="spilled"}} {}'.format(len(store.spilled) if store.spilled is not None else 0),
+        'domain_sessions{{state="restored"}} {}'.format(len(store.restored)),
+        '# TYPE domain_session_spills_total counter',
+        'domain_session_spills_total {}'.format(store.spills),
+        '# TYPE domain_session_faults_total counter',
+        'domain_session_faults_total {}'.format(store.faults),
+        '# TYPE domain_render_cache_hits_total counter',
+        'domain_render_cache_hits_total {}'.format(render_stats['hits']),
+        '# TYPE domain_render_cache_misses_total counter',
+        'domain_render_cache_misses_total {}'.format(render_stats['misses']),
+        '# TYPE domain_websocket_connections gauge',
+        'domain_websocket_connections {}'.format(len(sockets.connections)),
+        '# TYPE domain_websocket_frames_total counter',
+        'domain_websocket_frames_total {}'.format(sockets.frames),
+        '# HELP domain_websocket_pushes_total Room updates sent to watching connections unprompted.',
+        '# TYPE domain_websocket_pushes_total counter',
+        'domain_websocket_pushes_total {}'.format(sockets.pushed),
+        '# HELP domain_websocket_dropped_total Connections closed for not reading their replies and updates fast enough.',
+        '# TYPE domain_websocket_dropped_total counter',
+        'domain_websocket_dropped_total {}'.format(sockets.dropped),
+    ]
+    lines += [
+        '# HELP domain_requests_admitted User requests admitted and not finished, running or queued.',
+        '# TYPE domain_requests_admitted gauge',
+        'domain_requests_admitted {}'.format(actors.pending),
+        '# HELP domain_user_queue_depth Requests waiting behind another request of the same user.',
+        '# TYPE domain_user_queue_depth gauge',
+        'domain_user_queue_depth {}'.format(actors.queued()),
+        '# TYPE domain_users_busy gauge',
+        'domain_users_busy {}'.format(len(actors.queues)),
+        '# HELP domain_requests_rejected_total Requests turned away by admission control, by reason.',
+        '# TYPE domain_requests_rejected_total counter',
+    ]
+    for reason, n in sorted(actors.rejected.items()):
+        lines.append('domain_requests_rejected_total{{{}}} {}'.format(label('reason', reason), n))
+    outbox = req.app.outbox
+    lines += [
+        '# HELP domain_hub_outbox_pending Hub notifications waiting to be sent.',
+        '# TYPE domain_hub_outbox_pending gauge',
+        'domain_hub_outbox_pending {}'.format(len(outbox.pending)),
+        '# TYPE domain_hub_outbox_sent_total counter',
+        'domain_hub_outbox_sent_total {}'.format(outbox.sent),
+        '# TYPE domain_hub_outbox_dropped_total counter',
+        'domain_hub_outbox_dropped_total {}'.format(outbox.dropped),
+        '# TYPE domain_hub_outbox_coalesced_total counter',
+        'domain_hub_outbox_coalesced_total {}'.format(outbox.coalesced),
+        '# TYPE domain_hub_circuit_open gauge',
+        'domain_hub_circuit_open {}'.format(int(outbox.breaker_open())),
+    ]
+    if state_journal is not None:
+        lines.append('# TYPE domain_journal_bytes_total counter')
+        for kind in ('payload_bytes', 'log_bytes', 'snapshot_bytes'):
+            lines.append('domain_journal_bytes_total{{{}}} {}'.format(label('kind', kind), state_journal.stats[kind]))
+    return Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+async def start_loop_monitor(app):
+    app.loop_monitor = asyncio.create_task(monitor_loop_lag())
+
+async def stop_loop_monitor(app):
+    app.loop_monitor.cancel()
+
+
+class FinishHistogram(Histogram):
+    """Time from a session's start to its prize, in seconds."""
+    __slots__ = ()
+    bounds = (60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 86400)
+
+class Analytics:
+    """Gameplay counters kept up to date as commands run, served at /stats.
+
+    Every structure is sized by the world and the puzzles, not by the number of
+    players: entries per room, moves per (room, room) exit, one counter per funnel
+    stage and one histogram. Reading them never touches a session.
+    """
+
+    def __init__(self, funnel):
+        # (puzzle, state id) pairs a playthrough passes, in order
+        self.funnel = [(puzzle, puzzle.ids[state]) for puzzle, state in funnel]
+        self.stage_index = {key: i for i, key in enumerate(self.funnel)}
+        self.reached = [0] * len(self.funnel)
+        self.started = 0
+        self.finished = 0
+        self.visits = []
+        self.moves = {}
+        self.time_to_finish = FinishHistogram()
+
+    def start(self, user):
+        self.started += 1
+        self.enter(user.location)
+
+    def enter(self, room):
+        if room >= len(self.visits):
+            self.visits.extend([0] * (room + 1 - len(self.visits)))
+        self.visits[room] += 1
+
+    def move(self, source, target):
+        self.enter(target)
+        key = (source, target)
+        self.moves[key] = self.moves.get(key, 0) + 1
+
+    def stage(self, puzzle, state):
+        i = self.stage_index.get((puzzle, state))
+        if i is not None:
+            self.reached[i] += 1
+
+    def finish(self, user):
+        self.finished += 1
+        if user.started is not None:
+            self.time_to_finish.observe(max(0.0, time.time() - user.started))
+
+    def snapshot(self):
+        """The counters as JSON, with rooms by name; snapshots of several workers add up."""
+        rooms = {}
+        for room, n in enumerate(self.visits):
+            if n:
+                rooms.setdefault(room_names[room], {'visits': 0, 'exits': {}})['visits'] = n
+        for (source, target), n in self.moves.items():
+            rooms.setdefault(room_names[source], {'visits': 0, 'exits': {}})['exits'][room_names[target]] = n
+        histogram = self.time_to_finish
+        return {
+            'sessions': {'started': self.started, 'finished': self.finished},
+            'rooms': rooms,
+            'funnel': [{'stage': 'arrived', 'sessions': self.started}] + [
+                {'stage': '{}: {}'.format(puzzle.name, puzzle.states[state]), 'sessions': n}
+                for (puzzle, state), n in zip(self.funnel, self.reached)] + [{'stage': 'finished', 'sessions': self.finished}],
+            'time_to_finish': {
+                # sessions per bucket, keyed by its upper bound in seconds
+                'buckets': {str(bound): n for bound, n in zip(histogram.bounds + ('+Inf',), histogram.counts)},
+                'count': histogram.count,
+                'sum_seconds': histogram.total,
+            },
+        }
+
+analytics = Analytics([
+    (fish_tank, 'card discovered'),
+    (closet_door, 'unlocked'),
+    (piano, 'fixed'),
+    (piano, 'open'),
+    (starbucks, 'drink served'),
+    (starbucks, 'drink taken'),
+    (drink, 'investigated'),
+])
+
+def add_stats(total, more):
+    """Sum two /stats snapshots: numbers add, objects merge by key, lists by position."""
+    if isinstance(total, bool) or isinstance(total, str):
+        return total
+    if isinstance(total, (int, float)):
+        return total + more
+    if isinstance(total, dict):
+        merged = dict(more)
+        for key, value in total.items():
+            merged[key] = add_stats(value, more[key]) if key in more else value
+        return merged
+    return [add_stats(a, b) for a, b in zip(total, more)]
+
+@routes.get('/stats')
+async def handle_stats(req: Request) -> Response:
+    """How players move through the domain: room visits and moves, the puzzle funnel
+    and time to finish. With --workers, the sum over all workers."""
+    data = analytics.snapshot()
+    if worker_peers and req.headers.get('X-Shard-Forwarded') != internal_token:
+        data['missing_workers'] = []
+        for i, peer in enumerate(worker_peers):
+            if i == worker_index:
+                continue
+            try:
+                async with req.app.client.get(peer + '/stats', headers={'X-Shard-Forwarded': internal_token}) as resp:
+                    data = add_stats(data, await resp.json())
+            except (ClientError, asyncio.TimeoutError, ValueError):
+                data['missing_workers'].append(i)
+    started = data['sessions']['started']
+    for entry in data['funnel']:
+        entry['of_arrived'] = entry['sessions'] / started if started else 0.0
+    return json_response(data=data)
+
+
+class SelectionSettings(Message):
+    """A POST /debug/trace body, and the common part of a /debug/profile one; absent
+    fields leave the setting as it is."""
+    __slots__ = ('enabled', 'sample_rate', 'add_users', 'remove_users', 'clear')
+    fields = (
+        ('enabled', 'enabled', check_bool, None),
+        ('sample_rate', 'sample_rate', check_number, None),
+        ('add_users', 'add_users', check_users, ()),
+        ('remove_users', 'remove_users', check_users, ()),
+        ('clear', 'clear', check_bool, False),
+    )
+
+class Selection:
+    """Which requests or events a diagnostic tool looks at: everything for chosen
+    users, and a sampled fraction of the rest while enabled. Shared by the tracer
+    and the profiler."""
+    settings_message = SelectionSettings
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.users = set()
+
+    def wants(self, user_id=None):
+        if user_id in self.users:
+            return True
+        return self.enabled and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def configure(self, settings):
+        """Apply a settings body and return it decoded, or raise BadMessage and change nothing."""
+        msg = self.settings_message.decode(settings)
+        if msg.enabled is not None:
+            self.enabled = msg.enabled
+        if msg.sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(msg.sample_rate)))
+        self.users.update(msg.add_users)
+        self.users.difference_update(msg.remove_users)
+        return msg
+
+    def settings(self):
+        return {'enabled': self.enabled, 'sample_rate': self.sample_rate, 'users': sorted(self.users, key=str)}
+
+class Tracer(Selection):
+    """Structured diagnostic events kept in an in-memory ring buffer.
+
+    Tracing is off by default and then costs one attribute check per call site.
+    It can be switched on for a sampled fraction of events and/or for chosen users
+    (traced in full), at startup or through POST /debug/trace. Recording an event
+    is a deque append; with `sink_path` set, a background task hands new events to
+    a thread that appends them to that file as JSON lines. Read them back with
+    GET /debug/trace. Both endpoints want the domain secret (see refuse_operator).
+    """
+
+    def __init__(self, capacity=10000):
+        super().__init__()
+        self.events = deque(maxlen=capacity)
+        self.seq = 0
+        self.sink_path = None
+        self.drained = 0
+
+    def trace(self, event, user_id=None, **fields):
+        if (self.enabled or self.users) and self.wants(user_id):
+            self.emit(event, user_id, **fields)
+
+    def emit(self, event, user_id=None, **fields):
+        """Record an event unconditionally; callers check wants() first."""
+        self.seq += 1
+        self.events.append({'seq': self.seq, 'time': time.time(), 'event': event, 'user': user_id, **fields})
+
+    def query(self, user_id=None, event=None, since=0, limit=100):
+        # `user_id` comes from the query string, and user ids may be integers
+        matches = [e for e in self.events
+                   if e['seq'] > since and (user_id is None or str(e['user']) == user_id)
+                   and (event is None or e['event'] == event)]
+        return matches[-limit:]
+
+    def configure(self, settings):
+        msg = super().configure(settings)
+        if msg.clear:
+            self.events.clear()
+        return msg
+
+    def settings(self):
+        return dict(super().settings(), buffered=len(self.events), capacity=self.events.maxlen, seq=self.seq)
+
+    async def drain_loop(self, interval=1.0):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            batch = [e for e in self.events if e['seq'] > self.drained]
+            if batch:
+                self.drained = batch[-1]['seq']
+                await loop.run_in_executor(None, self.write, batch)
+
+    def write(self, batch):
+        with open(self.sink_path, 'a') as f:
+            for e in batch:
+                f.write(json.dumps(e, default=str) + '\n')
+
+tracer = Tracer()
+
+@routes.get('/debug/trace')
+async def get_trace(req: Request) -> Response:
+    """Buffered trace events, newest last. Filters: user, event, since (seq), limit."""
+    refused = refuse_operator(req)
+    if refused is not None:
+        return refused
+    q = req.query
+    try:
+        since, limit = int(q.get('since', 0)), int(q.get('limit', 100))
+    except ValueError:
+        return json_response(data={'error': 'since and limit must be integers'}, status=400)
+    events = tracer.query(q.get('user'), q.get('event'), since, limit)
+    return json_response(data={'settings': tracer.settings(), 'events': events}, dumps=lambda d: json.dumps(d, default=str))
+
+@routes.post('/debug/trace')
+async def configure_trace(req: Request) -> Response:
+    """Change tracing at runtime, e.g. {"add_users": ["alice"], "enabled": true, "sample_rate": 0.01}."""
+    refused = refuse_operator(req)
+    if refused is not None:
+        return refused
+    try:
+        tracer.configure(await req.json())
+    except ValueError as e:
+        return json_response(data={'error': 'bad trace settings: {}'.format(e)}, status=400)
+    return json_response(data=tracer.settings())
+
+async def start_tracer(app):
+    if tracer.sink_path is not None:
+        app.trace_drain = asyncio.create_task(tracer.drain_loop())
+
+async def stop_tracer(app):
+    if tracer.sink_path is not None:
+        app.trace_drain.cancel()
+
+
+class Profiled:
+    """Await a handler with `profile` switched on only while the handler itself runs.
+
+    Each step of the coroutine (up to its next await) runs between enable() and
+    disable(), so other requests interleaving on the event loop are not counted and
+    several profiled requests can be in flight at once. Time spent waiting (hub calls,
+    other users' turns) is left out; the latency histograms in /metrics cover it.
+    """
+
+    def __init__(self, coro, profile):
+        self.coro, self.profile = coro, profile
+
+    def __await__(self):
+        coro, profile = self.coro, self.profile
+        value, error = None, None
+        while True:
+            profile.enable()
+            try:
+                yielded = coro.send(value) if error is None else coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                profile.disable()
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def fold_stats(stats):
+    """Collapsed stacks ("a;b;c microseconds" per line) from pstats caller edges.
+
+    Each function's time is split between its callers in proportion to the time each
+    call edge took, as flameprof does, so stacks deeper than one call are estimates.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    folded = {}
+
+    def walk(func, stack, share):
+        _, _, own, cumulative, _ = stats.stats[func]
+        scale = share / cumulative if cumulative else 0.0
+        name = '{} ({}:{})'.format(func[2], os.path.basename(func[0]), func[1])
+        stack = stack + (name,)
+        key = ';'.join(stack)
+        folded[key] = folded.get(key, 0) + own * scale
+        for callee, edge in callees.get(func, ()):
+            if callee not in seen:
+                seen.add(callee)
+                walk(callee, stack, edge * scale)
+                seen.discard(callee)
+
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        if not callers:
+            seen = {func}
+            walk(func, (), cumulative)
+    return {key: int(seconds * 1e6) for key, seconds in folded.items() if seconds >= 1e-6}
+
+
+class ProfileSettings(SelectionSettings):
+    """A POST /debug/profile body: the selection, plus routes and whether to write the files."""
+    __slots__ = ('add_routes', 'remove_routes', 'write')
+    fields = SelectionSettings.fields + (
+        ('add_routes', 'add_routes', check_words, ()),
+        ('remove_routes', 'remove_routes', check_words, ()),
+        ('write', 'write', check_bool, False),
+    )
+
+class Profiler(Selection):
+    """cProfile data for chosen requests, aggregated per route.
+
+    Off by default, when the middleware costs one attribute check per request. It can
+    be switched on for a sampled fraction of requests, for chosen users (from the
+    body's "user") and/or for chosen routes, which are profiled in full, at startup or
+    through POST /debug/profile. POST /debug/profile with {"write": true} writes
+    <route>.pstats (load with pstats or snakeviz) and <route>.folded (collapsed
+    stacks for flamegraph.pl or speedscope) to `directory`.
+    """
+
+    settings_message = ProfileSettings
+
+    def __init__(self, directory='profiles'):
+        super().__init__()
+        self.directory = directory
+        self.active = False
+        self.routes = set()
+        self.stats = {}
+        self.requests = {}
+
+    def wants(self, user_id=None, route=None):
+        return route in self.routes or super().wants(user_id)
+
+    async def run(self, req, handler):
+        resource = req.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        user_id = await request_user(req) if self.users else None
+        if not self.wants(user_id, route):
+            return await handler(req)
+        profile = cProfile.Profile()
+        try:
+            return await Profiled(handler(req), profile)
+        finally:
+            if route in self.stats:
+                self.stats[route].add(profile)
+            else:
+                self.stats[route] = pstats.Stats(profile)
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def configure(self, settings):
+        msg = super().configure(settings)
+        self.routes.update(msg.add_routes)
+        self.routes.difference_update(msg.remove_routes)
+        if msg.clear:
+            self.stats, self.requests = {}, {}
+        self.active = bool(self.enabled or self.users or self.routes)
+        return msg
+
+    def settings(self):
+        return dict(super().settings(), routes=sorted(self.routes), directory=self.directory,
+                    profiled=self.requests)
+
+    def write(self, stats):
+        """Write each route's pstats and folded stacks; returns the file names."""
+        os.makedirs(self.directory, exist_ok=True)
+        written = []
+        for route, route_stats in stats.items():
+            name = route.strip('/').replace('/', '_').replace('{', '').replace('}', '') or 'root'
+            path = os.path.join(self.directory, name)
+            route_stats.dump_stats(path + '.pstats')
+            with open(path + '.folded', 'w') as f:
+                for stack, microseconds in sorted(fold_stats(route_stats).items()):
+                    f.write('{} {}\n'.format(stack, microseconds))
+            written += [path + '.pstats', path + '.folded']
+        return written
+
+profiler = Profiler()
+
+@web.middleware
+async def profile_requests(req, handler):
+    """Profile the request if the profiler is on and wants it."""
+    if not profiler.active:
+        return await handler(req)
+    return await profiler.run(req, handler)
+
+@routes.get('/debug/profile')
+async def get_profile(req: Request) -> Response:
+    """Profiler settings and the hottest functions of one route (?route=/command&limit=20)."""
+    refused = refuse_operator(req)
+    if refused is not None:
+        return refused
+    data = {'settings': profiler.settings()}
+    stats = profiler.stats.get(req.query.get('route'))
+    if stats is not None:
+        try:
+            limit = int(req.query.get('limit', 20))
+        except ValueError:
+            return json_response(data={'error': 'limit must be an integer'}, status=400)
+        rows = sorted(stats.stats.items(), key=lambda row: row[1][3], reverse=True)[:limit]
+        data['top'] = [{'function': '{} ({}:{})'.format(func[2], os.path.basename(func[0]), func[1]),
+                        'calls': calls, 'own_seconds': own, 'cumulative_seconds': cumulative}
+                       for func, (_, calls, own, cumulative, _) in rows]
+    return json_response(data=data)
+
+@routes.post('/debug/profile')
+async def configure_profile(req: Request) -> Response:
+    """Change profiling at runtime, e.g. {"add_routes": ["/command"]}, {"enabled": true,
+    "sample_rate": 0.01}, or {"write": true} to write the files."""
+    refused = refuse_operator(req)
+    if refused is not None:
+        return refused
+    try:
+        msg = profiler.configure(await req.json())
+    except ValueError as e:
+        return json_response(data={'error': 'bad profile settings: {}'.format(e)}, status=400)
+    data = profiler.settings()
+    if msg.write:
+        # hand the writer thread the stats as they are now; new requests start fresh copies
+        stats, profiler.stats = profiler.stats, {}
+        for route, route_stats in stats.items():
+            profiler.stats[route] = pstats.Stats().add(route_stats)
+        data['written'] = await asyncio.get_running_loop().run_in_executor(None, profiler.write, stats)
+    return json_response(data=data)
+
+async def stop_profiler(app):
+    if profiler.stats:
+        profiler.write(profiler.stats)
+
+
+class StateJournal:
+    """Durable game state: an append-only log of changed sessions plus compact snapshots.
+
+    Handlers only mark sessions dirty (SessionStore.touch). Every `flush_interval`
+    seconds each dirty session is pickled once and handed to a writer thread, which
+    appends it to the log, so the event loop never waits on the disk. Once the log
+    outgrows `snapshot_bytes` the writer folds it into the snapshot (last write wins)
+    and starts an empty log. restore() loads the snapshot and replays the log; the
+    sessions stay pickled until their users come back (see SessionStore.restored).
+
+    Log frames are a 4 byte big-endian length followed by a pickled record:
+    ('user', user_id, pickled session), ('hub', registration), or ('clear',) from
+    logs written before re-registration kept sessions.
+    """
+
+    def __init__(self, directory, flush_interval=0.05, snapshot_bytes=64 << 20, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'state.log')
+        self.snapshot_path = os.path.join(directory, 'state.snapshot')
+        self.flush_interval = flush_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync = fsync
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.task = None
+        self.log = None
+        self.stats = {
+            'records': 0,
+            'payload_bytes': 0,
+            'log_bytes': 0,
+            'snapshot_bytes': 0,
+            'snapshots': 0,
+            'restored_sessions': 0,
+            'restore_seconds': 0.0,
+        }
+
+    def load(self):
+        """Read the snapshot and replay the log over it. Returns (users, hub, valid log length)."""
+        users, hub = {}, None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            users, hub = snapshot['users'], snapshot['hub']
+        valid = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+            while valid + 4 <= len(data):
+                size, = struct.unpack_from('>I', data, valid)
+                if valid + 4 + size > len(data):
+                    break  # torn write at the tail
+                try:
+                    record = pickle.loads(data[valid + 4:valid + 4 + size])
+                except Exception:
+                    break
+                if record[0] == 'user':
+                    if record[2] is None:
+                        users.pop(record[1], None)
+                    else:
+                        users[record[1]] = record[2]
+                elif record[0] == 'clear':
+                    users.clear()
+                elif record[0] == 'hub':
+                    hub = record[1]
+                valid += 4 + size
+        return users, hub, valid
+
+    def restore(self, store):
+        """Fill `store` from disk and return the saved hub registration, if any."""
+        start = time.perf_counter()
+        users, hub, valid = self.load()
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > valid:
+            os.truncate(self.log_path, valid)
+        store.restored = users
+        self.stats['restored_sessions'] = len(users)
+        self.stats['restore_seconds'] = time.perf_counter() - start
+        print('restored {} sessions in {:.3f}s'.format(len(users), self.stats['restore_seconds']))
+        return hub
+
+    def append(self, record):
+        blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.stats['records'] += 1
+        self.stats['payload_bytes'] += len(blob)
+        self.queue.put(struct.pack('>I', len(blob)) + blob)
+
+    def record_registration(self):
+        """Log a /newhub: the hub, the catalog and the catalog id remappings changed."""
+        self.append(('hub', registration()))
+
+    def flush(self, store):
+        dirty, store.dirty = store.dirty, set()
+        for user_id in dirty:
+            self.append(('user', user_id, store.dump(user_id)))
+
+    def start(self, store):
+        store.dirty = set()
+        self.log = open(self.log_path, 'ab')
+        self.thread = threading.Thread(target=self.write_loop, name='state-journal', daemon=True)
+        self.thread.start()
+        self.task = asyncio.create_task(self.flush_loop(store))
+
+    async def flush_loop(self, store):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if store.dirty:
+                self.flush(store)
+
+    async def stop(self, store):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.flush(store)
+        self.queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+        written = self.stats['log_bytes'] + self.stats['snapshot_bytes']
+        print('journal: {} records, {} payload bytes, {} bytes written ({:.2f}x), {} snapshots'.format(
+            self.stats['records'], self.stats['payload_bytes'], written,
+            written / max(1, self.stats['payload_bytes']), self.stats['snapshots']))
+
+    def write_loop(self):
+        """Writer thread: append queued frames in groups, compacting when the log gets big."""
+        while True:
+            frames = [self.queue.get()]
+            while True:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in frames
+            data = b''.join(frame for frame in frames if frame is not None)
+            if data:
+                self.log.write(data)
+                self.log.flush()
+                if self.fsync:
+                    os.fsync(self.log.fileno())
+                self.stats['log_bytes'] += len(data)
+            if self.log.tell() >= self.snapshot_bytes:
+                self.compact()
+            if stop:
+                self.log.close()
+                return
+
+    def compact(self):
+        """Fold the log into a new snapshot and start an empty log (writer thread only)."""
+        self.log.close()
+        users, hub, _ = self.load()
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'hub': hub, 'users': users}, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            self.stats['snapshot_bytes'] += f.tell()
+        os.replace(tmp, self.snapshot_path)
+        self.log = open(self.log_path, 'wb')
+        self.stats['snapshots'] += 1
+
+# Catalog id changes made by re-registrations, oldest first (old id -> new id). A
+# session pickled when there were g of them has id_remaps[g:] applied when it is
+# loaded, so spilled and saved sessions are remapped on first use, not all at once.
+id_remaps = []
+
+def reconcile_catalog(catalog, outbox=None):
+    """Switch to a freshly registered catalog without dropping sessions.
+
+    Items are matched by name, which also folds duplicates left by older versions into
+    one entry. Ids that changed are remapped in resident sessions and queued hub
+    notifications now, and in the others when they are loaded. Re-registering with
+    the same ids changes no session, but cached renders are dropped all the same.
+    """
+    mapping = {}
+    for old_id, item in domain_state['items'].by_id.items():
+        new_ids = catalog.ids_named(item['name'])
+        if new_ids:
+            new_id = next(iter(new_ids))
+            if new_id != old_id:
+                mapping[old_id] = new_id
+    if mapping:
+        remap_sessions(mapping, outbox)
+    domain_state['items'] = catalog
+    invalidate_views()
+    return mapping
+
+def remap_sessions(mapping, outbox=None):
+    id_remaps.append(mapping)
+    for user in domain_state['users'].resident.values():
+        user.remap_items(mapping)
+    if outbox is not None:
+        outbox.remap(mapping)
+
+def registration():
+    """What /newhub learned from the hub, in a form that can be saved or sent to a peer."""
+    return {
+        'url': hub_server_url,
+        'id': domain_id,
+        'secret': domain_secret,
+        'items': list(domain_state['items']),
+        'remaps': id_remaps,
+    }
+
+def apply_registration(reg, outbox=None):
+    """Adopt a registration saved by the journal or made by another worker."""
+    global hub_server_url, domain_id, domain_secret
+    hub_server_url, domain_id, domain_secret = reg['url'], reg['id'], reg['secret']
+    for mapping in reg.get('remaps', [])[len(id_remaps):]:
+        remap_sessions(mapping, outbox)
+    domain_state['items'] = ItemIndex(reg['items'])
+    invalidate_views()
+
+
+# Multi-worker mode (--workers N). Every worker listens on the public port with
+# SO_REUSEPORT, so the kernel spreads connections across them, and on a private
+# port of its own. Each user belongs to exactly one worker (shard_of); a request
+# that lands on the wrong worker is passed to the owner over its private port, so
+# every session lives in one process and needs no locking or sharing.
+sharded_routes = {'/arrive', '/depart', '/dropped', '/command'}
+
+def shard_of(user_id):
+    return zlib.crc32(str(user_id).encode()) % len(worker_peers)
+
+@web.middleware
+async def shard_router(req, handler):
+    """Forward user requests to the owning worker and share /newhub results and world
+    reloads with every worker."""
+    if req.path in sharded_routes and req.headers.get('X-Shard-Forwarded') != internal_token:
+        user_id = await request_user(req)
+        # a bad request is left to the handler to report
+        owner = worker_index if user_id is None else shard_of(user_id)
+        if owner != worker_index:
+            try:
+                async with req.app.client.post(worker_peers[owner] + req.path, data=await req.read(), headers={
+                    'Content-Type': req.headers.get('Content-Type', 'application/json'),
+                    # the owner answers in the encoding the hub asked for, as a local reply would
+                    'Accept': req.headers.get('Accept', '*/*'),
+                    'X-Shard-Forwarded': internal_token,
+                }) as resp:
+                    return Response(body=await resp.read(), status=resp.status,
+                                    headers={'Content-Type': resp.headers.get('Content-Type', 'text/plain')})
+            except (ClientError, asyncio.TimeoutError) as e:
+                return reply(req, {'error': 'worker unavailable: {!r}'.format(e)}, status=502)
+    if req.path == '/commands' and req.headers.get('X-Shard-Forwarded') != internal_token:
+        resp = await split_batch(req)
+        if resp is not None:
+            return resp
+    resp = await handler(req)
+    if (req.path == '/world/reload' and resp.status == 200
+            and req.headers.get('X-Shard-Forwarded') != internal_token):
+        for i, peer in enumerate(worker_peers):
+            if i != worker_index:
+                async with req.app.client.post(peer + req.path, headers={'X-Shard-Forwarded': internal_token,
+                                                                         'X-Internal-Token': internal_token}) as peer_resp:
+                    if peer_resp.status != 200:
+                        print('worker {} did not reload the world: {}'.format(i, peer_resp.status))
+    if req.path == '/newhub' and resp.status == 200:
+        reg = registration()
+        for i, peer in enumerate(worker_peers):
+            if i != worker_index:
+                async with req.app.client.post(peer + '/internal/registration', json=reg,
+                                               headers={'X-Internal-Token': internal_token}) as peer_resp:
+                    if peer_resp.status != 200:
+                        print('worker {} did not take the registration: {}'.format(i, peer_resp.status))
+    return resp
+
+async def split_batch(req):
+    """Send each worker the part of a /commands batch for its users and merge the replies.
+    Returns None when every entry belongs here or the batch is malformed."""
+    try:
+        entries = await read_batch(req)
+    except web.HTTPException:
+        return None
+    groups = group_batch(entries)
+    shards = {}
+    for user_id, indexes in groups.items():
+        shards.setdefault(shard_of(user_id), {})[user_id] = indexes
+    if len(entries) > max_batch or list(shards) in ([], [worker_index]):
+        return None
+    results = [None] * len(entries)
+
+    async def send(owner, owned):
+        indexes = [i for user_indexes in owned.values() for i in user_indexes]
+        url = worker_peers[owner] + '/commands'
+        batch = [{'user': entries[i].user, 'command': entries[i].command} for i in indexes]
+        async with req.app.client.post(url, json=batch,
+                                       headers={'X-Shard-Forwarded': internal_token}) as resp:
+            if resp.status != 200:
+                raise ClientError('worker {} answered {}'.format(owner, resp.status))
+            for i, reply in zip(indexes, await resp.json()):
+                results[i] = reply
+
+    try:
+        await asyncio.gather(*(send(owner, owned) for owner, owned in shards.items() if owner != worker_index),
+                             run_batch(req, entries, shards.get(worker_index, {}), results))
+    except (ClientError, asyncio.TimeoutError) as e:
+        return reply(req, {'error': 'batch failed on another worker: {!r}'.format(e)}, status=502)
+    return reply(req, results)
+
+@routes.post('/internal/registration')
+async def receive_registration(req: Request) -> Response:
+    """Called by the worker that handled /newhub, so every worker talks to the same hub."""
+    if internal_token is None or req.headers.get('X-Internal-Token') != internal_token:
+        return json_response(data={'error': 'not found'}, status=404)
+    reg = await req.json()
+    # JSON object keys are strings; item ids are ints
+    reg['remaps'] = [{int(k) if k.isdigit() else k: v for k, v in mapping.items()} for mapping in reg.get('remaps', [])]
+    apply_registration(reg, req.app.outbox)
+    if state_journal is not None:
+        state_journal.record_registration()
+    return json_response(data={'ok': True})
+
+def configure_state(args, suffix=''):
+    """Set up the session store and restore saved state; `suffix` keeps workers' files apart."""
+    global state_journal, socket_queue_size
+    tracer.configure({'enabled': args.trace, 'sample_rate': args.trace_sample})
+    actors.max_pending, actors.max_queued = args.max_pending, args.max_user_queue
+    socket_queue_size = args.ws_queue
+    if args.world != world_path:
+        reload_world(args.world)
+    if args.trace_file:
+        tracer.sink_path = args.trace_file + suffix
+    profiler.directory = args.profile_dir + suffix
+    profiler.configure({'enabled': args.profile, 'sample_rate': args.profile_sample, 'add_routes': args.profile_route})
+    domain_state['users'] = SessionStore(args.max_sessions, args.spill_file + suffix)
+    if args.state_dir:
+        state_journal = StateJournal(args.state_dir + suffix, snapshot_bytes=args.snapshot_bytes, fsync=args.fsync)
+        reg = state_journal.restore(domain_state['users'])
+        if reg is not None:
+            apply_registration(reg)
+
+def build_app():
+    middlewares = [allow_cors, record_metrics, admit_requests]
+    if worker_peers:
+        middlewares.append(shard_router)
+    middlewares.append(profile_requests)
+    app = web.Application(middlewares=middlewares)
+    app.on_startup.append(start_session)
+    app.on_startup.append(start_outbox)
+    app.on_startup.append(start_journal)
+    app.on_startup.append(start_loop_monitor)
+    app.on_startup.append(start_tracer)
+    app.on_startup.append(watch_world_signal)
+    app.on_shutdown.append(close_sockets)
+    app.on_shutdown.append(stop_loop_monitor)
+    app.on_shutdown.append(stop_tracer)
+    app.on_shutdown.append(stop_profiler)
+    app.on_shutdown.append(stop_outbox)
+    app.on_shutdown.append(stop_journal)
+    app.on_shutdown.append(end_session)
+    app.on_cleanup.append(close_sessions)
+    app.add_routes(routes)
+    return app
+
+def run_worker(index, peers, token, args, public_url):
+    """Entry point of one worker process."""
+    global worker_index, worker_peers, internal_token, whoami
+    worker_index, worker_peers, internal_token, whoami = index, peers, token, public_url
+    # Ctrl+C reaches the whole process group; shutdown is driven by the parent's SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_state(args, '.{}'.format(index))
+
+    parent = os.getppid()
+
+    async def watch_parent(stop):
+        # a parent killed without the chance to stop its workers must not leave them serving
+        while os.getppid() == parent:
+            await asyncio.sleep(1.0)
+        stop.set()
+
+    async def serve():
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        watcher = asyncio.create_task(watch_parent(stop))
+        runner = web.AppRunner(build_app())
+        await runner.setup()
+        await web.TCPSite(runner, args.host, args.port, reuse_port=True).start()
+        await web.TCPSite(runner, '127.0.0.1', args.port + 1 + index).start()
+        try:
+            await stop.wait()
+        finally:
+            watcher.cancel()
+            await runner.cleanup()
+
+    asyncio.run(serve())
+
+def run_workers(args, public_url):
+    """Start args.workers worker processes and wait for them."""
+    token = secrets.token_hex(16)
+    peers = ['http://127.0.0.1:{}'.format(args.port + 1 + i) for i in range(args.workers)]
+    procs = [multiprocessing.Process(target=run_worker, args=(i, peers, token, args, public_url), name='worker-{}'.format(i))
+             for i in range(args.workers)]
+    for proc in procs:
+        proc.start()
+    # kill -HUP on the parent reloads the world in every worker
+    signal.signal(signal.SIGHUP, lambda signum, frame: [os.kill(proc.pid, signal.SIGHUP) for proc in procs])
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # kill -TERM on the parent stops the workers too (see the finally below)
+    signal.signal(signal.SIGTERM, stop)
+    print('======== {} workers on port {}, private ports {}-{} ========'.format(
+        args.workers, args.port, args.port + 1, args.port + args.workers))
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join()
+
+async def start_journal(app):
+    """Start logging session changes when persistence is enabled."""
+    if state_journal is not None:
+        state_journal.start(domain_state['users'])
+
+async def stop_journal(app):
+    """Write out the last changes and stop the journal writer."""
+    if state_journal is not None:
+        await state_journal.stop(domain_state['users'])
+
+async def start_outbox(app):
+    """Start the hub outbox worker once the ClientSession exists."""
+    app.outbox = HubOutbox(app.client)
+    app.outbox.start()
+
+async def close_sessions(app):
+    """Close the session spill file on shutdown."""
+    domain_state['users'].close()
+
+async def stop_outbox(app):
+    """Flush what the hub outbox can before the ClientSession is closed."""
+    await app.outbox.stop()
+
+
 
 
 
@@ -536,8 +2997,10 @@ async def allow_cors(req, handler):
 
 async def start_session(app):
     """To be run on startup of each event loop. Makes singleton ClientSession"""
-    from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    from aiohttp import ClientSession, ClientTimeout, TCPConnector
+    # hub calls go through a pooled, keep-alive connector; see HubOutbox
+    connector = TCPConnector(limit=100, limit_per_host=64, keepalive_timeout=30, ttl_dns_cache=300)
+    app.client = ClientSession(connector=connector, timeout=ClientTimeout(total=3, connect=1))
 
 async def end_session(app):
     """To be run on shutdown of each event loop. Closes the singleton ClientSession"""
@@ -549,6 +3012,40 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=3400)
+    parser.add_argument('--max-sessions', type=int, default=None,
+                        help='sessions kept in memory before the least recently used are spilled to disk')
+    parser.add_argument('--spill-file', type=str, default='sessions.spill',
+                        help='shelve file holding spilled sessions')
+    parser.add_argument('--state-dir', type=str, default=None,
+                        help='directory for the state log and snapshots; game state survives restarts')
+    parser.add_argument('--fsync', action='store_true',
+                        help='fsync the state log after every write')
+    parser.add_argument('--snapshot-bytes', type=int, default=64 << 20,
+                        help='state log size at which it is compacted into a snapshot')
+    parser.add_argument('--trace', action='store_true',
+                        help='record trace events for all users (see --trace-sample and /debug/trace)')
+    parser.add_argument('--trace-sample', type=float, default=1.0,
+                        help='fraction of events recorded when --trace is on')
+    parser.add_argument('--trace-file', type=str, default=None,
+                        help='also append trace events to this file, written off the event loop')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile requests (see --profile-sample and /debug/profile)')
+    parser.add_argument('--profile-sample', type=float, default=1.0,
+                        help='fraction of requests profiled when --profile is on')
+    parser.add_argument('--profile-route', action='append', default=[],
+                        help='always profile this route, e.g. /command (repeatable)')
+    parser.add_argument('--profile-dir', type=str, default='profiles',
+                        help='directory for .pstats and .folded flamegraph files')
+    parser.add_argument('--max-pending', type=int, default=2000,
+                        help='user requests in progress before new ones are answered 503')
+    parser.add_argument('--max-user-queue', type=int, default=8,
+                        help="requests waiting for one user before that user's next is answered 429")
+    parser.add_argument('--ws-queue', type=int, default=256,
+                        help='replies and room updates a /ws connection may have unsent before it is closed as too slow')
+    parser.add_argument('--world', type=str, default=world_path,
+                        help='world file with the rooms, exits and items (reloaded on SIGHUP)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes; users are sharded across them by id')
     args = parser.parse_args()
 
     import socket
@@ -559,8 +3056,8 @@ if __name__ == '__main__':
     print("URL to type into web prompt:\n\t"+whoami)
     print()
 
-    app = web.Application(middlewares=[allow_cors])
-    app.on_startup.append(start_session)
-    app.on_shutdown.append(end_session)
-    app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+    if args.workers > 1:
+        run_workers(args, whoami)
+    else:
+        configure_state(args)
+        web.run_app(build_app(), host=args.host, port=args.port)
@@ -0,0 +1,346 @@
+"""Load generator for the Illini Union domain.
+
+Starts the stand-in hub from fake-hub.py in this process, starts the domain
+(illini-union-domain.py) as a subprocess unless --domain points at a running one,
+registers the domain with /newhub, and then replays a full playthrough for every
+simulated user: /arrive, the fish tank -> closet -> piano -> starbucks -> drink
+chain of /commands, a /dropped and a /depart. With --visits, users come back
+that many times more (/arrive, look, /depart); --carried gives each user a large
+inventory from other domains and --delta sends returning users' /arrive as a delta.
+With --websocket every user sends their commands over a WebSocket (/ws) instead.
+Reports throughput, p50/p99 latency and request size per route and per command
+verb, and the domain's RSS growth.
+
+    python load-test.py --users 2000 --concurrency 200 --hub-latency 0.05
+    python load-test.py --users 500 --visits 5 --carried 200 --delta
+    python load-test.py --users 2000 --concurrency 200 --websocket
+"""
+from aiohttp import web, ClientSession, TCPConnector
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The chain from the README of this domain, plus the detours players usually take.
+PLAYTHROUGH = [
+    'look', 'go east', 'go west', 'take rubber-gloves', 'go north', 'look fishtank',
+    'go fishing', 'look', 'take i-card', 'go west', 'use i-card closet', 'go west',
+    'take sheet-music', 'take piano-key', 'go east', 'go south', 'use piano-key piano',
+    'play piano', 'open piano', 'take drink-voucher', 'go west', 'go east', 'go east',
+    'give voucher', 'use voucher starbucks', 'take peppermint-mocha',
+    'drink peppermint-mocha', 'look', 'take golden-ticket', 'look sheet-music', 'go west',
+    'sing', 'go south',
+]
+
+
+def load_fake_hub():
+    spec = importlib.util.spec_from_file_location('fake_hub', os.path.join(HERE, 'fake-hub.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def rss_kb(pid):
+    """Resident set size of a process in kB, from /proc (Linux only)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """The processes whose parent is `pid`, from /proc (Linux only)."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the name in parentheses may contain spaces; the parent pid is second after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+def tree_rss_kb(pid):
+    """RSS summed over a process and its descendants, and how many there were.
+
+    With --workers the domain's parent process only waits on its workers, so its own
+    RSS says little. Pages the workers share with the parent since fork are counted
+    once for each process that has them.
+    """
+    total, count, pending = 0, 0, [pid]
+    while pending:
+        pid = pending.pop()
+        rss = rss_kb(pid)
+        if rss is None:
+            continue
+        total, count = total + rss, count + 1
+        pending += child_pids(pid)
+    return (total, count) if count else (None, 0)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class Recorder:
+    """Latency samples per route and per command verb, plus error counts."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.sent = {}
+
+    def add(self, key, seconds, ok, size=0):
+        self.samples.setdefault(key, []).append(seconds)
+        self.sent[key] = self.sent.get(key, 0) + size
+        if not ok:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.samples.values())
+        lines = ['{} requests in {:.2f}s: {:.0f} req/s'.format(total, elapsed, total / elapsed if elapsed else 0)]
+        lines.append('{:<28} {:>8} {:>10} {:>10} {:>10} {:>8}'.format(
+            'route', 'count', 'p50 ms', 'p99 ms', 'avg bytes', 'errors'))
+        for key in sorted(self.samples):
+            samples = self.samples[key]
+            lines.append('{:<28} {:>8} {:>10.2f} {:>10.2f} {:>10.0f} {:>8}'.format(
+                key, len(samples), percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000,
+                self.sent[key] / len(samples), self.errors.get(key, 0)))
+        return '\n'.join(lines)
+
+    def summary(self, elapsed):
+        return {
+            key: {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.5) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'avg_bytes': self.sent[key] / len(samples),
+                'errors': self.errors.get(key, 0),
+            }
+            for key, samples in self.samples.items()
+        }
+
+
+def encoder(use_msgpack):
+    """Request keyword arguments that send a payload as JSON, or as msgpack."""
+    if not use_msgpack:
+        headers = {'Content-Type': 'application/json'}
+        return lambda payload: {'data': json.dumps(payload).encode(), 'headers': headers}
+    import msgpack
+    headers = {'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
+    return lambda payload: {'data': msgpack.packb(payload), 'headers': headers}
+
+
+async def timed(client, recorder, url, route, key=None, **kwargs):
+    start = time.perf_counter()
+    async with client.post(url + route, **kwargs) as resp:
+        body = await resp.read()
+        ok = resp.status < 400
+    seconds = time.perf_counter() - start
+    size = len(kwargs.get('data', b''))
+    recorder.add(route, seconds, ok, size)
+    if key is not None:
+        recorder.add(key, seconds, ok, size)
+    return resp.status, body
+
+
+class Commands:
+    """Sends one user's commands as /command requests, or as frames on a /ws connection.
+    `token(user)` is the user's play token, sent with their first frame."""
+
+    def __init__(self, client, recorder, url, encode, ws=None, token=None):
+        self.client, self.recorder, self.url, self.encode, self.ws = client, recorder, url, encode, ws
+        self.token = token
+        self.shown = set()
+
+    async def send(self, user, command):
+        if self.ws is None:
+            status, body = await timed(self.client, self.recorder, self.url, '/command',
+                                       key='/command ' + command[0], **self.encode({'user': user, 'command': command}))
+            return body
+        message = {'user': user, 'command': command}
+        if user not in self.shown:
+            message['token'] = self.token(user)
+            self.shown.add(user)
+        frame = json.dumps(message)
+        start = time.perf_counter()
+        await self.ws.send_str(frame)
+        while True:
+            data = await self.ws.receive_json()
+            if 'event' not in data:
+                break  # room updates the domain pushes are skipped
+        seconds = time.perf_counter() - start
+        for key in ('/ws', '/ws ' + command[0]):
+            self.recorder.add(key, seconds, data['status'] < 400, len(frame))
+        return data['text'].encode()
+
+
+async def arrive(client, recorder, url, inventories, user, origin, secret, inventory, encode):
+    """/arrive through the hub's Inventories, resending in full if the domain asks for it."""
+    status, body = await timed(client, recorder, url, '/arrive',
+                               **encode(inventories.arrive(user, origin, secret, inventory)))
+    if status == 409:
+        inventories.resync(user)
+        status, body = await timed(client, recorder, url, '/arrive', key='/arrive resync',
+                                   **encode(inventories.arrive(user, origin, secret, inventory)))
+    if status == 200:
+        inventories.accepted(user)
+
+
+async def play(client, recorder, url, secret, user, inventory, dropped_item, encode, inventories, visits, commands):
+    """One simulated user's visit to the domain, and `visits` returns after it."""
+    finished = False
+    await arrive(client, recorder, url, inventories, user, 'login', secret, inventory, encode)
+    for line in PLAYTHROUGH:
+        body = await commands.send(user, line.split())
+        finished = finished or b'congrats' in body
+    await timed(client, recorder, url, '/dropped', **encode({'user': user, 'secret': secret, 'item': dropped_item}))
+    await timed(client, recorder, url, '/depart', **encode({'user': user, 'secret': secret}))
+    for visit in range(visits):
+        # the hub hands the user something new between visits
+        inventory = dict(inventory, carried=inventory['carried'] + [
+            {'id': 'souvenir-{}-{}'.format(user, visit), 'name': 'souvenir', 'description': 'A keepsake.', 'verb': {}}])
+        await arrive(client, recorder, url, inventories, user, 'south', secret, inventory, encode)
+        await commands.send(user, ['look'])
+        await timed(client, recorder, url, '/depart', **encode({'user': user, 'secret': secret}))
+    return finished
+
+
+async def wait_until_up(client, url, proc, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('domain exited with code {}'.format(proc.returncode))
+        try:
+            async with client.post(url + '/command', json={'user': '__probe__', 'command': ['look']}):
+                return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('domain at {} did not come up'.format(url))
+
+
+async def main(args):
+    fake_hub = load_fake_hub()
+    hub_app = fake_hub.make_app(args.hub_latency, args.hub_jitter, args.hub_fail_rate)
+    runner = web.AppRunner(hub_app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.hub_port).start()
+    hub_url = 'http://127.0.0.1:{}'.format(args.hub_port)
+
+    proc = None
+    url = args.domain
+    if url is None:
+        url = 'http://127.0.0.1:{}'.format(args.port)
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'illini-union-domain.py'), '--host', '127.0.0.1',
+             '-p', str(args.port)] + args.domain_args.split(),
+            stdout=subprocess.DEVNULL if not args.verbose else None, stderr=subprocess.STDOUT)
+
+    recorder = Recorder()
+    try:
+        # WebSockets get their own pool, so open ones never hold up the HTTP requests
+        async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as client, ClientSession() as sockets:
+            await wait_until_up(client, url, proc)
+            async with client.post(url + '/newhub', data=hub_url) as resp:
+                if resp.status != 200:
+                    raise RuntimeError('/newhub failed: {} {}'.format(resp.status, await resp.text()))
+            state = hub_app['state']
+            domain = state['domains'][max(state['domains'])]
+            items = {state['items'][i]['name']: state['items'][i] for i in domain['items']}
+            prizes = [items['rubber-gloves'], items['piano-key'], {
+                'id': 10 ** 6, 'name': 'golden-ticket', 'description': 'A prize from the hub.',
+                'verb': {}, 'depth': 2,
+            }]
+
+            rss_before, processes = tree_rss_kb(proc.pid) if proc is not None else (None, 0)
+            semaphore = asyncio.Semaphore(args.concurrency)
+            encode = encoder(args.msgpack)
+            inventories = fake_hub.Inventories(delta=args.delta)
+
+            def inventory(n):
+                carried = [{'id': 'other-{}-{}'.format(n, i), 'name': 'trinket-{}'.format(i),
+                            'description': 'Something from another domain.', 'verb': {}}
+                           for i in range(args.carried)]
+                return {'owned': [], 'carried': carried, 'dropped': [], 'prize': prizes}
+
+            async def one(n):
+                async with semaphore:
+                    ws = await sockets.ws_connect(url + '/ws') if args.websocket else None
+                    try:
+                        return await play(client, recorder, url, domain['secret'], 'user-{}'.format(n),
+                                          inventory(n), items['sheet-music'], encode, inventories, args.visits,
+                                          Commands(client, recorder, url, encode, ws,
+                                                   lambda user: fake_hub.play_token(domain['secret'], user)))
+                    finally:
+                        if ws is not None:
+                            await ws.close()
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(one(n) for n in range(args.users)))
+            elapsed = time.perf_counter() - start
+            # let the domain's hub outbox catch up before reading its memory
+            await asyncio.sleep(0.5)
+            rss_after, processes = tree_rss_kb(proc.pid) if proc is not None else (None, 0)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        await runner.cleanup()
+
+    print(recorder.report(elapsed))
+    print('{} of {} users finished the domain'.format(sum(results), args.users))
+    print('hub calls received: {}'.format(state['counts']))
+    if rss_before is not None and rss_after is not None:
+        print('domain RSS: {} kB -> {} kB ({:+d} kB, {:.2f} kB/user{})'.format(
+            rss_before, rss_after, rss_after - rss_before, (rss_after - rss_before) / args.users,
+            ', summed over {} processes'.format(processes) if processes > 1 else ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'elapsed': elapsed,
+                'users': args.users,
+                'finished': sum(results),
+                'routes': recorder.summary(elapsed),
+                'hub': state['counts'],
+                'rss_kb': [rss_before, rss_after],
+                'rss_processes': processes,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000, help='simulated users, one playthrough each')
+    parser.add_argument('--concurrency', type=int, default=100, help='users playing at the same time')
+    parser.add_argument('--domain', type=str, default=None, help='URL of a running domain; default starts one')
+    parser.add_argument('-p', '--port', type=int, default=3401, help='port for the domain this script starts')
+    parser.add_argument('--domain-args', type=str, default='', help='extra arguments for the domain it starts')
+    parser.add_argument('--hub-port', type=int, default=3301)
+    parser.add_argument('--hub-latency', type=float, default=0.0, help='seconds the fake hub takes per call')
+    parser.add_argument('--hub-jitter', type=float, default=0.0)
+    parser.add_argument('--hub-fail-rate', type=float, default=0.0)
+    parser.add_argument('--visits', type=int, default=0, help='times each user comes back after the playthrough')
+    parser.add_argument('--carried', type=int, default=0, help='items from other domains each user carries')
+    parser.add_argument('--delta', action='store_true', help="send returning users' /arrive as a delta")
+    parser.add_argument('--msgpack', action='store_true', help='send request bodies as msgpack (needs msgpack)')
+    parser.add_argument('--websocket', action='store_true', help='send commands over /ws instead of /command')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the domain's output")
+    asyncio.run(main(parser.parse_args()))
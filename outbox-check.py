@@ -0,0 +1,166 @@
+"""Check the domain's HubOutbox against fake-hub.py's hub failing on purpose.
+
+Loads illini-union-domain.py in-process and points a HubOutbox at hubs built
+with fake-hub.py's make_app, each registered like a real domain would be:
+
+- against a hub that fails every call, the circuit breaker opens after
+  failure_threshold failed rounds, every notification is dropped after
+  max_attempts, and the hub sees no calls while the breaker is open;
+- against a hub that fails --fail-rate of calls, every notification queued is
+  counted once as sent, dropped or coalesced, sent is what the hub counted, and
+  each user's score at the hub is the last one queued;
+- with max_pending reached, the oldest notifications are dropped.
+
+Exits 1 at the first failed check.
+
+    python outbox-check.py
+    python outbox-check.py --fail-rate 0.5 --users 500 --seed 3
+"""
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+import argparse
+import asyncio
+import importlib.util
+import os
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def expect(ok, message):
+    if not ok:
+        print(message)
+        sys.exit(1)
+
+
+async def start_hub(fake_hub, domain, client, fail_rate):
+    """Start a fake hub and register the domain with it (retrying its failures)."""
+    server = TestServer(fake_hub.make_app(fail_rate=fail_rate))
+    await server.start_server()
+    domain.hub_server_url = str(server.make_url('')).rstrip('/')
+    for _ in range(100):
+        async with client.post(domain.hub_server_url + '/register', json={'url': 'http://domain', 'items': []}) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                domain.domain_id, domain.domain_secret = data['id'], data['secret']
+                return server
+    # a hub that fails every call cannot be registered with; its calls fail before the secret is checked
+    domain.domain_id, domain.domain_secret = None, None
+    return server
+
+
+def settled(outbox):
+    return outbox.sent + outbox.dropped + outbox.coalesced
+
+
+async def drain(outbox, queued, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while settled(outbox) < queued and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    await outbox.stop(timeout=0)
+
+
+async def check_breaker(domain, fake_hub, client):
+    server = await start_hub(fake_hub, domain, client, fail_rate=1.0)
+    counts = server.app['state']['counts']
+    registering = counts['failed']
+    outbox = domain.HubOutbox(client, max_attempts=3, base_delay=0.01, max_delay=0.02,
+                              failure_threshold=3, reset_timeout=0.5)
+    for n in range(5):
+        outbox.transfer('user-{}'.format(n), n + 1, 'south')
+    outbox.start()
+    await drain(outbox, 5, timeout=5)
+    expect(outbox.breaker_open(), 'the breaker is closed after {} failed rounds'.format(outbox.failures))
+    expect(outbox.sent == 0 and outbox.dropped == 5,
+           'against a dead hub: sent {}, dropped {}, expected 0 and 5'.format(outbox.sent, outbox.dropped))
+    expect(counts['failed'] - registering == 15, 'the hub failed {} calls, expected 5 notifications x 3 attempts'.format(
+        counts['failed'] - registering))
+    # while the breaker is open the worker waits instead of calling the hub
+    outbox.start()
+    outbox.score('late', 1)
+    await asyncio.sleep(0.2)
+    expect(counts['failed'] - registering == 15, 'the hub was called while the breaker was open')
+    await outbox.stop(timeout=0)
+    await server.close()
+
+
+async def check_flaky(domain, fake_hub, client, args):
+    server = await start_hub(fake_hub, domain, client, fail_rate=args.fail_rate)
+    state = server.app['state']
+    registering = state['counts']['failed']
+    # enough attempts that nothing is dropped at this fail rate
+    outbox = domain.HubOutbox(client, batch_size=32, max_attempts=50, base_delay=0.001, max_delay=0.01,
+                              failure_threshold=10 ** 6)
+    rng = random.Random(args.seed)
+    users = ['user-{}'.format(n) for n in range(args.users)]
+    latest = {}
+    # queued before the worker starts, so every repeat is coalesced into one notification
+    for _ in range(args.scores):
+        user = rng.choice(users)
+        latest[user] = latest.get(user, 0) + rng.randrange(1, 10)
+        outbox.score(user, latest[user])
+    expect(len(outbox.pending) == len(latest) and outbox.coalesced == args.scores - len(latest),
+           '{} scores for {} users left {} queued, {} coalesced'.format(
+               args.scores, len(latest), len(outbox.pending), outbox.coalesced))
+    for n, user in enumerate(users):
+        outbox.transfer(user, n + 1, 'south')
+    outbox.start()
+    # and more while it runs: a newer score replaces a queued or a failed one
+    for _ in range(args.scores):
+        user = rng.choice(users)
+        latest[user] = latest.get(user, 0) + rng.randrange(1, 10)
+        outbox.score(user, latest[user])
+        await asyncio.sleep(0)
+    queued = 2 * args.scores + len(users)
+    await drain(outbox, queued, timeout=60)
+    counts = state['counts']
+    expect(settled(outbox) == queued and not outbox.pending, 'sent {} + dropped {} + coalesced {} != {} queued'.format(
+        outbox.sent, outbox.dropped, outbox.coalesced, queued))
+    expect(outbox.dropped == 0, '{} notifications dropped after 50 attempts'.format(outbox.dropped))
+    expect(outbox.sent == counts['transfer'] + counts['score'], 'sent {}, the hub counted {} transfers and {} scores'.format(
+        outbox.sent, counts['transfer'], counts['score']))
+    failed = counts['failed'] - registering
+    expect(failed > 0, 'the hub failed no calls at --fail-rate {}'.format(args.fail_rate))
+    stale = {user: (state['scores'].get(user), score) for user, score in latest.items() if state['scores'].get(user) != score}
+    expect(not stale, 'the hub holds an older score than the last one queued (hub, last): {}'.format(stale))
+    await server.close()
+    return outbox.sent, failed
+
+
+async def check_overflow(domain, client):
+    outbox = domain.HubOutbox(client, max_pending=10)
+    for n in range(15):
+        outbox.transfer('user-{}'.format(n), n + 1, 'south')
+    expect(outbox.dropped == 5 and len(outbox.pending) == 10,
+           'max_pending 10 after 15: dropped {}, queued {}'.format(outbox.dropped, len(outbox.pending)))
+    expect(next(iter(outbox.pending))[1] == 'user-5', 'the oldest notifications were not the ones dropped')
+
+
+async def main(args):
+    domain = load_script('domain', 'illini-union-domain.py')
+    fake_hub = load_script('fake_hub', 'fake-hub.py')
+    random.seed(args.seed)
+    async with ClientSession() as client:
+        await check_breaker(domain, fake_hub, client)
+        sent, failed = await check_flaky(domain, fake_hub, client, args)
+        await check_overflow(domain, client)
+    print('breaker opened; {} notifications sent through {} hub failures; max_pending dropped the oldest'.format(
+        sent, failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fail-rate', type=float, default=0.3)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--scores', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
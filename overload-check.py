@@ -0,0 +1,75 @@
+"""Check that the domain's admission control turns work away under overload.
+
+Starts the domain (illini-union-domain.py) with small --max-pending and
+--max-user-queue limits, then sends two bursts of concurrent /command requests:
+one for many different users, which should get some 503s, and one for a single
+user, which should get some 429s. Exits 1 if either burst was answered entirely
+with 200s.
+
+    python overload-check.py
+    python overload-check.py --requests 800 --max-pending 20 --max-user-queue 1
+"""
+from aiohttp import ClientSession, TCPConnector
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+async def wait_until_up(client, url, proc, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('domain exited with code {}'.format(proc.returncode))
+        try:
+            async with client.post(url + '/command', json={'user': '__probe__', 'command': ['look']}):
+                return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('domain at {} did not come up'.format(url))
+
+
+async def burst(client, url, users):
+    """Send one /command per entry of `users` at once; returns {status: count}."""
+    async def one(user):
+        async with client.post(url + '/command', json={'user': user, 'command': ['look']}) as resp:
+            await resp.read()
+            return resp.status
+    statuses = {}
+    for status in await asyncio.gather(*(one(user) for user in users)):
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+async def main(args):
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'illini-union-domain.py'), '--host', '127.0.0.1', '-p', str(args.port),
+         '--max-pending', str(args.max_pending), '--max-user-queue', str(args.max_user_queue)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        async with ClientSession(connector=TCPConnector(limit=0)) as client:
+            await wait_until_up(client, url, proc)
+            many = await burst(client, url, ['user-{}'.format(n) for n in range(args.requests)])
+            one = await burst(client, url, ['user-0'] * args.requests)
+    finally:
+        proc.terminate()
+        proc.wait()
+    print('{} users at once:  {}'.format(args.requests, many))
+    print('{} requests for one user: {}'.format(args.requests, one))
+    ok = many.get(503, 0) > 0 and one.get(429, 0) > 0
+    print('admission control works' if ok else 'no 503 for many users or no 429 for one user')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=3402)
+    parser.add_argument('--requests', type=int, default=400, help='requests in each burst')
+    parser.add_argument('--max-pending', type=int, default=20)
+    parser.add_argument('--max-user-queue', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""Check the domain's puzzles against the transitions they are meant to have.
+
+Loads illini-union-domain.py in-process (see headless.py) and, for every Puzzle,
+fires each of its events from each of its states and compares the resulting
+stage with MACHINES below. The other puzzles are left in their last stage, which
+must not change. Then the playthrough from load-test.py is played on one session
+and each puzzle must reach its stage at the command in STAGES, for example the
+piano 'open' at 'open piano' and the barista 'drink served' at 'give voucher'.
+Exits 1 at the first difference.
+
+    python puzzle-check.py
+"""
+import importlib.util
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# puzzle -> (states, {event: {from: to}}); any other state stays where it is
+MACHINES = {
+    'fish tank': (['with card', 'card discovered', 'card taken'], {
+        'fish': {'with card': 'card discovered', 'card discovered': 'card taken'},
+    }),
+    'closet door': (['locked', 'unlocked'], {
+        'swipe': {'locked': 'unlocked'},
+    }),
+    'piano': (['missing key', 'fixed', 'open'], {
+        'insert key': {'missing key': 'fixed'},
+        'open': {'fixed': 'open'},
+    }),
+    'starbucks': (['has drink', 'drink served', 'drink taken'], {
+        'serve': {'has drink': 'drink served'},
+        'pick up': {'drink served': 'drink taken'},
+    }),
+    'drink': (['undiscovered', 'investigated'], {
+        'spill': {'undiscovered': 'investigated'},
+    }),
+}
+
+# (puzzle, stage, playthrough command that reaches it)
+STAGES = [
+    ('fish tank', 'card discovered', 'go fishing'),
+    ('closet door', 'unlocked', 'use i-card closet'),
+    ('piano', 'fixed', 'use piano-key piano'),
+    ('piano', 'open', 'open piano'),
+    ('starbucks', 'drink served', 'give voucher'),
+    ('starbucks', 'drink taken', 'use voucher starbucks'),
+    ('drink', 'investigated', 'drink peppermint-mocha'),
+]
+
+
+def load_script(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stages(domain, user):
+    return {puzzle.name: puzzle.states[puzzle.stage(user)] for puzzle in domain.puzzles}
+
+
+def check_tables(domain):
+    """Fire every event from every state; returns the number of transitions tried."""
+    names = sorted(puzzle.name for puzzle in domain.puzzles)
+    if names != sorted(MACHINES):
+        raise AssertionError('puzzles are {}, expected {}'.format(names, sorted(MACHINES)))
+    tried = 0
+    for puzzle in domain.puzzles:
+        states, events = MACHINES[puzzle.name]
+        if list(puzzle.states) != states:
+            raise AssertionError('{}: states are {}, expected {}'.format(puzzle.name, list(puzzle.states), states))
+        if sorted(puzzle.table) != sorted(events):
+            raise AssertionError('{}: events are {}, expected {}'.format(puzzle.name, sorted(puzzle.table), sorted(events)))
+        for event, moves in events.items():
+            for state in states:
+                user = domain.Session()
+                for other in domain.puzzles:
+                    other.set(user, other.states[-1])
+                puzzle.set(user, state)
+                before = stages(domain, user)
+                moved = puzzle.fire(user, event)
+                want = dict(before, **{puzzle.name: moves.get(state, state)})
+                got = stages(domain, user)
+                if got != want or moved != (state in moves):
+                    raise AssertionError('{}: {!r} from {!r} gave {} (moved {}), expected {}'.format(
+                        puzzle.name, event, state, got, moved, want))
+                tried += 1
+    return tried
+
+
+def check_playthrough(engine, playthrough):
+    """Play load-test.py's playthrough; every STAGES entry must be reached at its command."""
+    domain = engine.domain
+    user = engine.session('puzzle-check')
+    reached = {}
+    for line in playthrough:
+        before = stages(domain, user)
+        engine.step('puzzle-check', line.split())
+        for name, stage in stages(domain, user).items():
+            if stage != before[name]:
+                reached[name, stage] = line
+    for name, stage, line in STAGES:
+        if reached.get((name, stage)) != line:
+            raise AssertionError('{} should reach {!r} at {!r}, reached it at {!r}'.format(
+                name, stage, line, reached.get((name, stage))))
+    missed = {(name, stage) for name, stage in reached} - {(name, stage) for name, stage, line in STAGES}
+    if missed:
+        raise AssertionError('stages reached that STAGES does not list: {}'.format(sorted(missed)))
+
+
+def main():
+    engine = load_script('headless', 'headless.py').Engine()
+    playthrough = load_script('load_test', 'load-test.py').PLAYTHROUGH
+    try:
+        tried = check_tables(engine.domain)
+        check_playthrough(engine, playthrough)
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
+    print('{} transitions and {} playthrough stages as expected'.format(tried, len(STAGES)))
+
+
+if __name__ == '__main__':
+    main()